@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# Admission control
+#
+# Decide, up front, whether the server can take on another
+# control operation, so that overload results in a quick
+# rejection rather than a pile-up of blocked threads
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import math
+import threading
+import time
+
+
+class Overloaded(Exception):
+    ''' Raised when an operation is refused admission
+
+    retry_after gives the number of seconds after which the
+    client should try again
+    '''
+    def __init__(self, msg, retry_after=1, reason="busy"):
+        super().__init__(msg)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    ''' Bound the number of control operations in progress
+
+    An operation is refused if `max_pending` operations are already
+    in progress, or if the requests already queued for the upstream
+    rate limit mean that its own request(s) couldn't be placed within
+    `max_wait` seconds - it would only end in RateLimitExceeded, after
+    having tied up a thread waiting
+    '''
+
+    def __init__(self, scheduler, max_pending=8, max_wait=8, debug=False):
+        self.scheduler = scheduler
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.debug = debug
+
+        self.lock = threading.Lock()
+        self.pending = 0
+
+        # Exponentially weighted average of how long operations take
+        self.avg_duration = 0
+        self.stats = {
+            "admitted" : 0,
+            "rejected_queue_full" : 0,
+            "rejected_upstream" : 0
+            }
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+
+    def upstreamWait(self):
+        ''' Estimate how long a new request would wait for a rate limit slot
+        '''
+        return self.scheduler.ratelimiter.estimateWait(self.scheduler.waiting())
+
+    def admit(self, operation):
+        ''' Reserve capacity for an operation, returning the time it was
+        admitted (to be passed to release)
+
+        Raises Overloaded if it can't be accepted
+        '''
+        wait = self.upstreamWait()
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.stats['rejected_queue_full'] += 1
+                # Operations finish together (they're coalesced into a
+                # single write), so the queue drains in roughly the time
+                # that an operation takes
+                retry_after = max(1, math.ceil(max(self.avg_duration, wait)))
+                self.printDebug(f'ADMISSION: Refused {operation}, {self.pending} pending')
+                raise Overloaded(f"{self.pending} operations pending", retry_after, "queue_full")
+
+            if wait > self.max_wait:
+                self.stats['rejected_upstream'] += 1
+                self.printDebug(f'ADMISSION: Refused {operation}, upstream wait {wait:.2f}s')
+                raise Overloaded(f"Upstream rate limit saturated ({wait:.2f}s wait)",
+                                 max(1, math.ceil(wait - self.max_wait)), "upstream")
+
+            self.pending += 1
+            self.stats['admitted'] += 1
+
+        return time.time()
+
+    def release(self, admitted):
+        ''' Mark an operation as complete
+        '''
+        duration = time.time() - admitted
+        with self.lock:
+            self.pending -= 1
+            self.avg_duration = duration if not self.avg_duration else (0.8 * self.avg_duration) + (0.2 * duration)
+
+    def getStats(self):
+        ''' Return the current queue depth along with admission counts
+        '''
+        with self.lock:
+            res = dict(self.stats)
+            res['pending'] = self.pending
+            res['max_pending'] = self.max_pending
+            res['avg_duration'] = self.avg_duration
+
+        res['upstream_wait'] = self.upstreamWait()
+        return res
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+#
+# Historical energy backfill
+#
+# Walks a date range fetching per-day (inverterMonth) or
+# per-month (inverterYear) energy history for a set of
+# inverters, writing it out as CSV or Parquet
+#
+# Progress is checkpointed, so an interrupted run can be
+# resumed by running the same command again
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import soliscloud_control
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = False
+
+
+# Attributes of each history record to export
+FIELDS = [
+    "energy",
+    "gridPurchasedEnergy",
+    "gridSellEnergy",
+    "homeLoadEnergy",
+    "batteryChargeEnergy",
+    "batteryDischargeEnergy"
+    ]
+
+
+class CSVPartWriter:
+    ''' Write rows to a CSV file
+    '''
+
+    extension = "csv"
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.fh = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.fh, fieldnames=columns, extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.fh.close()
+
+
+class ParquetPartWriter:
+    ''' Write rows to a Parquet file, a row group per write
+    '''
+
+    extension = "parquet"
+
+    def __init__(self, path, columns):
+        if not pyarrow:
+            raise ImportError("Parquet output requires pyarrow: pip install pyarrow")
+
+        self.path = path
+        self.columns = columns
+        self.schema = pyarrow.schema(
+            [("sn", pyarrow.string()), ("date", pyarrow.string())]
+            + [(c, pyarrow.float64()) for c in columns[2:]]
+            )
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if rows:
+            self.writer.write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {
+    "csv" : CSVPartWriter,
+    "parquet" : ParquetPartWriter
+    }
+
+
+class Backfill:
+    ''' Export energy history for a set of inverters
+
+    The work is split into tasks, one per inverter per month (for
+    per-day history) or year (for per-month history), each costing
+    a single request. Tasks are fetched in parallel, sharing the
+    client's rate limit, and written by the calling thread.
+
+    Output is written to numbered part files in output_dir. Once a
+    part holds part_tasks tasks it's closed and the checkpoint is
+    updated to record them as done, so a run which is killed loses
+    (and on resume, re-fetches) at most one part's worth of tasks.
+    A part left behind by an interrupted run is overwritten
+    '''
+
+    def __init__(self, soliscloud, serials, start, end, output_dir, granularity="day", fmt="csv",
+                 workers=4, part_tasks=50, time_zone=0, fields=FIELDS, debug=False):
+        if granularity not in ["day", "month"]:
+            raise ValueError(f'granularity should be day or month, not {granularity}')
+
+        self.soliscloud = soliscloud
+        self.serials = list(serials)
+        self.start = start
+        self.end = end
+        self.output_dir = output_dir
+        self.granularity = granularity
+        self.fmt = fmt
+        self.writer_class = WRITERS[fmt]
+        self.workers = workers
+        self.part_tasks = part_tasks
+        self.time_zone = time_zone
+        self.columns = ["sn", "date"] + list(fields)
+        self.debug = debug
+
+        self.checkpoint_path = os.path.join(output_dir, "checkpoint.json")
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+
+    def job(self):
+        ''' Describe the run, so that a checkpoint from a
+        different one isn't resumed by mistake
+        '''
+        return {
+            "serials" : self.serials,
+            "start" : self.start,
+            "end" : self.end,
+            "granularity" : self.granularity,
+            "format" : self.fmt,
+            "columns" : self.columns
+            }
+
+    def periods(self):
+        ''' List the periods to request: months (YYYY-MM) when fetching
+        per-day history, otherwise years (YYYY)
+        '''
+        if self.granularity == "month":
+            return [str(y) for y in range(int(self.start[:4]), int(self.end[:4]) + 1)]
+
+        year, month = [int(x) for x in self.start[:7].split("-")]
+        periods = []
+        while f"{year:04d}-{month:02d}" <= self.end[:7]:
+            periods.append(f"{year:04d}-{month:02d}")
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return periods
+
+    def tasks(self):
+        return [f"{sn}/{period}" for sn in self.serials for period in self.periods()]
+
+    def loadCheckpoint(self):
+        ''' Load the checkpoint, or start a new one
+        '''
+        if not os.path.exists(self.checkpoint_path):
+            return {"job" : self.job(), "done" : [], "parts" : [], "rows" : 0}
+
+        with open(self.checkpoint_path) as fh:
+            checkpoint = json.load(fh)
+
+        if checkpoint['job'] != self.job():
+            raise ValueError(f'{self.checkpoint_path} is for a different backfill, use a new output directory')
+
+        return checkpoint
+
+    def saveCheckpoint(self, checkpoint):
+        ''' Atomically replace the checkpoint
+        '''
+        tmp = f"{self.checkpoint_path}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump(checkpoint, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.checkpoint_path)
+
+    def inRange(self, date):
+        ''' Check whether a record's date (YYYY-MM or YYYY-MM-DD) falls
+        within the requested range, comparing at the coarser of the two
+        '''
+        start = self.start[:len(date)]
+        end = self.end[:len(date)]
+        return start <= date[:len(start)] and date[:len(end)] <= end
+
+    def maxWait(self):
+        ''' How long the backfill's requests may wait for a rate limit slot
+
+        Requests queue for the shared rate limit, so the usual safety net
+        needs to allow for every worker (and its retries). Only the
+        backfill's own requests get the longer wait
+        '''
+        ratelimiter = self.soliscloud.ratelimiter
+        max_wait = (math.ceil((self.workers * self.soliscloud.retry_policy.max_attempts) / ratelimiter.limit)
+                    * ratelimiter.window + ratelimiter.window)
+        return max(self.soliscloud.config['max_ratelimit_wait'], max_wait)
+
+    def fetch(self, task):
+        ''' Fetch a task's records and turn them into rows
+
+        Returns False if the request failed
+        '''
+        sn, period = task.split("/")
+        with self.soliscloud.rateLimitWait(self.maxWait()):
+            if self.granularity == "day":
+                records = self.soliscloud.getInverterMonth(sn, period, self.time_zone)
+            else:
+                records = self.soliscloud.getInverterYear(sn, period, self.time_zone)
+
+        if records is False:
+            return False
+
+        rows = []
+        for r in records:
+            date = r.get("dateStr", "")
+
+            # Years requested for per-month history may extend
+            # beyond the requested range
+            if not self.inRange(date):
+                continue
+
+            row = {"sn" : sn, "date" : date}
+            for c in self.columns[2:]:
+                row[c] = float(r[c]) if r.get(c, None) is not None else None
+            rows.append(row)
+
+        return rows
+
+    def run(self):
+        ''' Run (or resume) the backfill
+
+        Returns a summary including the tasks which failed (which will
+        be retried if the backfill is run again) and the achieved
+        request rate
+        '''
+        os.makedirs(self.output_dir, exist_ok=True)
+        checkpoint = self.loadCheckpoint()
+        done = set(checkpoint['done'])
+        pending = [t for t in self.tasks() if t not in done]
+        self.printDebug(f'BACKFILL: {len(done)} tasks already done, {len(pending)} to go')
+
+        ratelimiter = self.soliscloud.ratelimiter
+        start = time.time()
+        requests_before = ratelimiter.total
+
+        failed = []
+        writer = False
+        part_done = []
+        part_rows = 0
+
+        def closePart():
+            nonlocal writer, part_done, part_rows
+            if not writer:
+                return
+            writer.close()
+            checkpoint['parts'].append(os.path.basename(writer.path))
+            checkpoint['done'] += part_done
+            checkpoint['rows'] += part_rows
+            self.saveCheckpoint(checkpoint)
+            writer, part_done, part_rows = False, [], 0
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                tasks = iter(pending)
+                in_flight = {}
+                while True:
+                    # Keep a bounded number of tasks queued so that
+                    # results don't pile up in memory
+                    while len(in_flight) < self.workers * 2:
+                        task = next(tasks, False)
+                        if not task:
+                            break
+                        in_flight[executor.submit(self.fetch, task)] = task
+
+                    if not in_flight:
+                        break
+
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        task = in_flight.pop(future)
+                        try:
+                            rows = future.result()
+                        except Exception as e:
+                            self.printDebug(f'BACKFILL: {task} failed: {e}')
+                            rows = False
+
+                        if rows is False:
+                            failed.append(task)
+                            continue
+
+                        if not writer:
+                            path = os.path.join(self.output_dir,
+                                                f"part-{len(checkpoint['parts']):05d}.{self.writer_class.extension}")
+                            writer = self.writer_class(path, self.columns)
+
+                        writer.write(rows)
+                        part_done.append(task)
+                        part_rows += len(rows)
+                        if len(part_done) >= self.part_tasks:
+                            closePart()
+        finally:
+            # Whatever was written is complete, so keep it
+            closePart()
+
+        elapsed = time.time() - start
+        requests = ratelimiter.total - requests_before
+        ideal_elapsed = ratelimiter.idealElapsed(requests)
+        return {
+            "tasks" : len(pending),
+            "completed" : len(pending) - len(failed),
+            "failed" : failed,
+            "rows" : checkpoint['rows'],
+            "parts" : checkpoint['parts'],
+            "elapsed" : elapsed,
+            "requests" : requests,
+            "achieved_rps" : ratelimiter.sustainedRate(requests, elapsed),
+            "ceiling_rps" : ratelimiter.maxThroughput(),
+            "ideal_elapsed" : ideal_elapsed,
+            "utilisation" : (ideal_elapsed / elapsed) if elapsed else 0
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export historical energy data from Soliscloud")
+    parser.add_argument("--start", required=True, help="First month to export (YYYY-MM)")
+    parser.add_argument("--end", required=True, help="Last month to export (YYYY-MM)")
+    parser.add_argument("--output", required=True, help="Directory to write to (and resume from)")
+    parser.add_argument("--granularity", default="day", choices=["day", "month"], help="Per-day or per-month totals")
+    parser.add_argument("--format", default="csv", choices=list(WRITERS.keys()))
+    parser.add_argument("--serials", help="Comma separated inverter serials, default INVERTER_SERIALS")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent requests")
+    parser.add_argument("--part-tasks", type=int, default=50, help="Tasks per output file (and checkpoint)")
+    parser.add_argument("--timezone", type=int, default=0, help="Timezone offset, in hours, for day boundaries")
+    args = parser.parse_args()
+
+    DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+
+    config = soliscloud_control.configFromEnv()
+    soliscloud = soliscloud_control.SolisCloud(config, debug=DEBUG)
+    serials = [x.strip() for x in args.serials.split(",")] if args.serials else config['inverters']
+
+    backfill = Backfill(soliscloud, serials, args.start, args.end, args.output, args.granularity, args.format,
+                        args.workers, args.part_tasks, args.timezone, debug=DEBUG)
+    res = backfill.run()
+
+    print(f"{res['completed']} of {res['tasks']} tasks completed, {len(res['failed'])} failed, "
+          f"{res['rows']} rows in {len(res['parts'])} files")
+    print(f"{res['requests']} requests in {res['elapsed']:.2f}s: {res['achieved_rps']:.2f} req/s after the initial burst "
+          f"against a ceiling of {res['ceiling_rps']:.2f} req/s")
+    print(f"The rate limit allows this in {res['ideal_elapsed']:.2f}s ({res['utilisation'] * 100:.0f}% utilisation)")
+
+    if res['failed']:
+        print("Run again to retry failed tasks")
+        sys.exit(1)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+#
+# Command coalescing
+#
+# Collapses control commands which arrive in quick succession
+# into a single read-modify-write against the API
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import copy
+import threading
+import time
+
+from concurrent.futures import Future
+
+
+class CommandQueue:
+    ''' Per-inverter queue of pending schedule changes
+
+    Each command is a function which mutates a timings dict. Commands
+    which are queued whilst a write is in flight are applied, in the
+    order received, to a single copy of the schedule which is then
+    written with one call to setChargeDischargeTimings. If several
+    commands are already queued, the worker also waits `window` seconds
+    for the rest of the burst to arrive. A lone command is written
+    straight away.
+
+    Only one write is in flight at a time, and every caller whose
+    command was merged into a write receives that write's outcome. A
+    command which raises (or produces an invalid schedule) is rejected
+    on its own, without affecting the others in its batch
+    '''
+
+    def __init__(self, soliscloud, window=0.5, debug=False):
+        self.soliscloud = soliscloud
+        self.window = window
+        self.debug = debug
+
+        self.pending = []
+        self.cond = threading.Condition()
+
+        self.stats = {
+            "commands" : 0,
+            "flushes" : 0
+            }
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+
+    def submitAsync(self, mutate):
+        ''' Queue a change, returning a Future which will
+        receive the outcome
+        '''
+        future = Future()
+        with self.cond:
+            self.pending.append((mutate, future))
+            self.stats["commands"] += 1
+            self.cond.notify()
+        return future
+
+    def submit(self, mutate, timeout=None):
+        ''' Queue a change and wait for the outcome
+        '''
+        return self.submitAsync(mutate).result(timeout)
+
+    def run(self):
+        ''' Worker loop: take everything that's pending and
+        write it as a single change
+        '''
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                burst = len(self.pending) > 1
+
+            # Commands are arriving in quick succession, give the
+            # rest of them a chance to arrive
+            if burst and self.window:
+                time.sleep(self.window)
+
+            with self.cond:
+                batch = self.pending
+                self.pending = []
+
+            self.flush(batch)
+
+    def flush(self, batch):
+        ''' Apply a batch of changes with a single write
+        '''
+        self.printDebug(f'COMMAND_QUEUE: Writing {len(batch)} coalesced command(s)')
+
+        rejected = {}
+
+        def mutate(timings):
+            # Try each command against a copy, so that one which fails
+            # doesn't leave a partial change behind
+            rejected.clear()
+            for m, future in batch:
+                trial = copy.deepcopy(timings)
+                try:
+                    m(trial)
+                    self.soliscloud.validateTimingsObj(trial)
+                except Exception as e:
+                    self.printDebug(f'COMMAND_QUEUE: Rejecting command: {e}')
+                    rejected[future] = e
+                    continue
+
+                timings.clear()
+                timings.update(trial)
+
+        try:
+            result = self.soliscloud.updateSchedule(mutate)
+        except Exception as e:
+            for m, future in batch:
+                future.set_exception(rejected.get(future, e))
+            return
+
+        with self.cond:
+            self.stats["flushes"] += 1
+
+        for m, future in batch:
+            if future in rejected:
+                future.set_exception(rejected[future])
+            else:
+                future.set_result(result)
+
+    def getStats(self):
+        ''' Return the number of commands received and
+        batches flushed
+        '''
+        with self.cond:
+            stats = dict(self.stats)
+            stats['pending'] = len(self.pending)
+        return stats
+
+    # Convenience wrappers mirroring the control methods of SolisCloud
+
+    def startCharge(self, hours=3, exact=False, rates=False):
+        return self.immediateStart("charge", hours, exact, rates)
+
+    def startDischarge(self, hours=3, exact=False, rates=False):
+        return self.immediateStart("discharge", hours, exact, rates)
+
+    def stopCharge(self, rates=False):
+        return self.immediateStop(rates)
+
+    def stopDischarge(self, rates=False):
+        return self.immediateStop(rates)
+
+    def immediateStart(self, action="charge", hours=3, exact=False, rates=False):
+        ''' Queue the start of a charge or discharge
+        '''
+        # Calculate the range now, rather than when the batch is written
+        timerange = self.soliscloud.calculateDynamicTimeRange(hours, exact)
+
+        def mutate(timings):
+            self.soliscloud.setSlotAction(timings, action, timerange)
+            self.soliscloud.applyRates(timings, rates)
+
+        return self.submit(mutate)
+
+    def immediateStop(self, rates=False):
+        ''' Queue a stop
+        '''
+        def mutate(timings):
+            self.soliscloud.setSlotAction(timings, "stop")
+            self.soliscloud.applyRates(timings, rates)
+
+        return self.submit(mutate)
+
+    def setCurrents(self, rates):
+        ''' Queue a change of currents
+        '''
+        return self.submit(lambda timings: self.soliscloud.applyRates(timings, rates))
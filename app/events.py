@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+# Event broadcasting
+#
+# Fan events (schedule changes, command progress) out to
+# any number of subscribers, each with a bounded buffer
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import collections
+import json
+import threading
+import time
+
+
+class Subscriber:
+    ''' A single consumer's view of the event stream
+
+    Events are buffered until collected. If the buffer fills the
+    subscriber is closed rather than silently losing events - the
+    consumer can reconnect and resume from the last id it saw
+    '''
+
+    def __init__(self, buffer_size=100):
+        self.buffer_size = buffer_size
+        self.events = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def push(self, event):
+        ''' Queue an event for delivery
+
+        Returns False if the subscriber is closed, or has just been
+        closed because its buffer is full
+        '''
+        with self.cond:
+            if self.closed:
+                return False
+
+            if len(self.events) >= self.buffer_size:
+                self.closed = True
+                self.cond.notify_all()
+                return False
+
+            self.events.append(event)
+            self.cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        ''' Return the next event, blocking for up to timeout seconds
+
+        Returns None on timeout and False once the subscriber has
+        been closed and drained
+        '''
+        with self.cond:
+            if not self.events and not self.closed:
+                self.cond.wait(timeout)
+
+            if self.events:
+                return self.events.popleft()
+
+            return False if self.closed else None
+
+    def close(self):
+        ''' Stop accepting events and wake any waiting consumer
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class EventBroadcaster:
+    ''' Publish events to every current subscriber
+
+    The most recent `history` events are retained so that a
+    subscriber which reconnects can catch up on what it missed
+    '''
+
+    def __init__(self, buffer_size=100, history=100, max_subscribers=8, debug=False):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.debug = debug
+
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.history = collections.deque(maxlen=history)
+        self.last_id = 0
+        self.stats = {
+            "published" : 0,
+            "overflowed" : 0
+            }
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+
+    def publish(self, event, data):
+        ''' Send an event to all subscribers
+
+        Returns the event's id
+        '''
+        with self.lock:
+            self.last_id += 1
+            entry = {
+                "id" : self.last_id,
+                "event" : event,
+                "time" : time.time(),
+                "data" : data
+                }
+            self.history.append(entry)
+            self.stats['published'] += 1
+            subscribers = list(self.subscribers)
+
+        for sub in subscribers:
+            if not sub.push(entry):
+                self.printDebug('EVENTS: Subscriber overflowed, disconnecting')
+                self.unsubscribe(sub, overflowed=True)
+
+        return entry['id']
+
+    def subscribe(self, last_id=None):
+        ''' Register a new subscriber
+
+        If last_id is provided, any retained events published after
+        it are queued for delivery first
+
+        Returns False if the subscriber limit has been reached
+        '''
+        sub = Subscriber(self.buffer_size)
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return False
+
+            if last_id is not None:
+                for entry in self.history:
+                    if entry['id'] > last_id:
+                        sub.push(entry)
+
+            self.subscribers.add(sub)
+
+        return sub
+
+    def unsubscribe(self, sub, overflowed=False):
+        ''' Remove a subscriber, closing it
+        '''
+        sub.close()
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.discard(sub)
+                if overflowed:
+                    self.stats['overflowed'] += 1
+
+    def getStats(self):
+        ''' Return publish counts and the number of current subscribers
+        '''
+        with self.lock:
+            res = dict(self.stats)
+            res['subscribers'] = len(self.subscribers)
+            res['last_id'] = self.last_id
+            return res
+
+
+def formatSSE(entry):
+    ''' Render an event in Server-Sent Events wire format
+    '''
+    return f"id: {entry['id']}\nevent: {entry['event']}\ndata: {json.dumps(entry['data'])}\n\n"
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#
+# Fleet control
+#
+# Drive many inverters concurrently whilst observing a
+# single, shared, rate limit budget
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import inspect
+import math
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import soliscloud_control
+
+from journal import ScheduleJournal
+
+
+class SolisFleet:
+    ''' Run operations against many inverters at once
+
+    Soliscloud's rate limit is applied per source IP, so every
+    inverter behind the same egress IP has to share it. Each
+    inverter gets its own SolisCloud instance, but they share
+    per-thread sessions (and so connection pools), a Transport, a
+    RateLimiter and a RequestScheduler.
+    '''
+
+    def __init__(self, config, serials=False, debug=False, max_workers=8):
+        self.config = config
+        self.debug = debug
+        self.max_workers = max_workers
+
+        if not serials:
+            serials = config['inverters']
+
+        self.ratelimiter = soliscloud_control.rateLimiterFromConfig(config)
+
+        self.scheduler = soliscloud_control.RequestScheduler(self.ratelimiter, config.get('scheduler_aging', 10))
+
+        self.transport = soliscloud_control.Transport(
+            config.get('connect_timeout', 5),
+            config.get('read_timeout', 30),
+            config.get('pool_size', 10)
+            )
+
+        # A single journal (and so a single database connection) for all inverters
+        self.journal = False
+        if config.get('journal_path', False):
+            self.journal = ScheduleJournal(config['journal_path'], config.get('journal_keep', 100), debug=debug)
+
+        self.clients = {}
+        sessions = threading.local()
+        for sn in serials:
+            c = dict(config)
+            c['inverter'] = sn
+            self.clients[sn] = soliscloud_control.SolisCloud(c, debug=debug, ratelimiter=self.ratelimiter,
+                                                             sessions=sessions, transport=self.transport,
+                                                             journal=self.journal, scheduler=self.scheduler)
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+
+    def runOne(self, sn, operation, args, kwargs, max_wait=None):
+        ''' Run operation against a single inverter and
+        capture the outcome
+
+        Requests it places may wait up to max_wait seconds for a
+        rate limit slot
+        '''
+        start = time.time()
+        res = {
+            "inverter" : sn,
+            "operation" : operation,
+            "result" : False,
+            "error" : False
+            }
+
+        client = self.clients[sn]
+        method = getattr(client, operation)
+
+        # Reads take the serial, control methods act on the client's
+        # configured inverter
+        if "sn" in inspect.signature(method).parameters and "sn" not in kwargs:
+            kwargs = dict(kwargs, sn=sn)
+
+        try:
+            with client.rateLimitWait(max_wait):
+                res["result"] = method(*args, **kwargs)
+        except Exception as e:
+            self.printDebug(f'FLEET: {operation} on {sn} failed: {e}')
+            res["error"] = str(e)
+
+        res["elapsed"] = time.time() - start
+        return res
+
+    def run(self, operation, *args, serials=False, **kwargs):
+        ''' Run a SolisCloud method (e.g. startCharge) against each
+        inverter, yielding per-inverter results as they complete
+
+        Any additional arguments are passed through to the method
+        '''
+        if not serials:
+            serials = list(self.clients.keys())
+
+        # Every call will queue for the shared rate limit, so the
+        # usual safety net for waits needs to scale with the size
+        # of the run. Assume the worst case of 2 requests per inverter
+        max_wait = math.ceil((2 * len(serials)) / self.ratelimiter.limit) * self.ratelimiter.window
+        max_wait = max(self.config['max_ratelimit_wait'], max_wait + self.ratelimiter.window)
+
+        # The allowance only applies to this run's requests, other
+        # users of the clients keep the configured safety net
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.runOne, sn, operation, args, kwargs, max_wait) for sn in serials]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def runAll(self, operation, *args, serials=False, **kwargs):
+        ''' Run an operation against the fleet and wait for it to complete
+
+        Returns a summary including per-inverter results, the time taken
+        and how the achieved request rate compares to the rate limit.
+        achieved_rps excludes the initial burst (see sustainedRate) and
+        utilisation is the quickest the rate limit would have allowed the
+        run to complete in (ideal_elapsed) as a fraction of elapsed
+        '''
+        start = time.time()
+        requests_before = self.ratelimiter.total
+
+        results = {}
+        for res in self.run(operation, *args, serials=serials, **kwargs):
+            results[res['inverter']] = res
+
+        elapsed = time.time() - start
+        requests = self.ratelimiter.total - requests_before
+        ideal_elapsed = self.ratelimiter.idealElapsed(requests)
+
+        return {
+            "results" : results,
+            "succeeded" : len([r for r in results.values() if r['result']]),
+            "failed" : len([r for r in results.values() if not r['result']]),
+            "elapsed" : elapsed,
+            "requests" : requests,
+            "achieved_rps" : self.ratelimiter.sustainedRate(requests, elapsed),
+            "ceiling_rps" : self.ratelimiter.maxThroughput(),
+            "ideal_elapsed" : ideal_elapsed,
+            "utilisation" : (ideal_elapsed / elapsed) if elapsed else 0
+            }
+
+
+if __name__ == "__main__":
+    # Are we running in debug mode?
+    DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} [startCharge|stopCharge|startDischarge|stopDischarge|readChargeDischargeSchedule]")
+        sys.exit(1)
+
+    config = soliscloud_control.configFromEnv()
+    fleet = SolisFleet(config, debug=DEBUG)
+
+    start = time.time()
+    requests_before = fleet.ratelimiter.total
+    failed = 0
+
+    for res in fleet.run(sys.argv[1]):
+        status = "ok" if res['result'] else f"failed {res['error'] or ''}"
+        print(f"{res['inverter']}: {status} ({res['elapsed']:.2f}s)")
+        if not res['result']:
+            failed += 1
+
+    elapsed = time.time() - start
+    requests = fleet.ratelimiter.total - requests_before
+    print(f"{len(fleet.clients)} inverters, {failed} failed, {requests} requests in {elapsed:.2f}s "
+          f"({fleet.ratelimiter.sustainedRate(requests, elapsed):.2f} req/s after the initial burst, "
+          f"ceiling {fleet.ratelimiter.maxThroughput():.2f} req/s)")
+
+    if failed:
+        sys.exit(1)
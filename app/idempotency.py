@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# Idempotency
+#
+# Remember the outcome of requests which carried an
+# Idempotency-Key, so that retries don't repeat the work
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class IdempotencyCache:
+    ''' A bounded, TTL evicted, record of operations by key
+
+    The first request with a given key is told to run the operation
+    and record the result. Duplicates which arrive afterwards receive
+    the recorded result, those which arrive whilst it's in progress
+    are told so (rather than waiting, and tying up a thread).
+
+    If the operation doesn't produce a result worth keeping (it
+    failed, or was refused) it's abandoned and the next request with
+    that key will run it again
+
+    Completed entries are retained for `ttl` seconds, with the least
+    recently used evicted first if there are more than max_entries
+    '''
+
+    def __init__(self, max_entries=1000, ttl=86400, debug=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.debug = debug
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {
+            "executed" : 0,
+            "replayed" : 0,
+            "in_progress" : 0,
+            "abandoned" : 0,
+            "evicted" : 0
+            }
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+
+    def begin(self, key, fingerprint=None):
+        ''' Look up key
+
+        Returns a tuple of (entry, owner). If owner is True, the caller
+        must run the operation and then call complete() or abandon().
+        Otherwise entry describes an existing operation, which may still
+        be in progress (see outcome)
+        '''
+        with self.lock:
+            self.evictExpired()
+            entry = self.entries.get(key, False)
+            if entry:
+                self.entries.move_to_end(key)
+                return entry, False
+
+            self.evictExcess()
+            entry = {
+                "key" : key,
+                "fingerprint" : fingerprint,
+                "created" : time.time(),
+                "finished" : False,
+                "abandoned" : False,
+                "result" : None
+                }
+            self.entries[key] = entry
+            self.stats['executed'] += 1
+            return entry, True
+
+    def outcome(self, entry):
+        ''' Check on an existing operation
+
+        Returns its result, False if it was abandoned or None if
+        it's still in progress
+        '''
+        with self.lock:
+            if entry['abandoned']:
+                return False
+
+            if not entry['finished']:
+                self.stats['in_progress'] += 1
+                return None
+
+            self.stats['replayed'] += 1
+            return entry['result']
+
+    def complete(self, entry, result):
+        ''' Record the result of an operation
+        '''
+        with self.lock:
+            entry['result'] = result
+            entry['finished'] = time.time()
+
+    def abandon(self, entry):
+        ''' Forget an operation without recording a result, so that
+        it'll be run again if retried
+        '''
+        with self.lock:
+            entry['abandoned'] = True
+            if self.entries.get(entry['key'], False) is entry:
+                del self.entries[entry['key']]
+            self.stats['abandoned'] += 1
+
+        self.printDebug(f'IDEMPOTENCY: Abandoned {entry["key"]}')
+
+    def evictExpired(self):
+        ''' Drop completed entries older than the TTL
+
+        Must be called with the lock held
+        '''
+        cutoff = time.time() - self.ttl
+        for key in [k for k, e in self.entries.items() if e['finished'] and e['finished'] < cutoff]:
+            del self.entries[key]
+            self.stats['evicted'] += 1
+
+    def evictExcess(self):
+        ''' Make room for a new entry by dropping the least recently
+        used. Operations still in progress are kept
+
+        Must be called with the lock held
+        '''
+        excess = len(self.entries) - self.max_entries
+        if excess < 0:
+            return
+
+        for key in [k for k, e in self.entries.items() if e['finished']][:excess + 1]:
+            del self.entries[key]
+            self.stats['evicted'] += 1
+
+    def getStats(self):
+        ''' Return counts of how keys have been used
+        '''
+        with self.lock:
+            res = dict(self.stats)
+            res['entries'] = len(self.entries)
+            return res
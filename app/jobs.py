@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# Background jobs
+#
+# Allows the control server to accept a request, hand it
+# off to a worker pool and let the client collect the
+# outcome later
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobManager:
+    ''' Run operations on a worker pool and track their outcome
+
+    Finished jobs are retained for `ttl` seconds so that clients
+    can collect the result
+    '''
+
+    def __init__(self, workers=4, ttl=3600, debug=False):
+        self.ttl = ttl
+        self.debug = debug
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+
+    def submit(self, operation, fn, *args, **kwargs):
+        ''' Queue fn to be run in the background
+
+        Returns a copy of the job's state, including its id
+        '''
+        job = {
+            "id" : uuid.uuid4().hex,
+            "operation" : operation,
+            "status" : "queued",
+            "created" : time.time(),
+            "started" : False,
+            "finished" : False,
+            "result" : None,
+            "error" : False
+            }
+        done = threading.Event()
+
+        with self.lock:
+            self.evict()
+            self.jobs[job['id']] = (job, done)
+            res = self.snapshot(job)
+
+        self.executor.submit(self.run, job, done, fn, args, kwargs)
+        self.printDebug(f'JOBS: Queued {operation} as {job["id"]}')
+        return res
+
+    def run(self, job, done, fn, args, kwargs):
+        ''' Execute a job and record the outcome
+        '''
+        with self.lock:
+            job['status'] = "running"
+            job['started'] = time.time()
+
+        try:
+            result = fn(*args, **kwargs)
+            status = "succeeded" if result else "failed"
+            error = False
+        except Exception as e:
+            result = None
+            status = "failed"
+            error = str(e)
+
+        with self.lock:
+            job['status'] = status
+            job['result'] = result
+            job['error'] = error
+            job['finished'] = time.time()
+
+        self.printDebug(f'JOBS: {job["id"]} {status}')
+        done.set()
+
+    def get(self, job_id, wait=0):
+        ''' Return a copy of a job's state, or False if it's unknown
+
+        If wait is non-zero, block for up to that many seconds for
+        the job to finish
+        '''
+        with self.lock:
+            entry = self.jobs.get(job_id, False)
+
+        if not entry:
+            return False
+
+        job, done = entry
+        if wait:
+            done.wait(wait)
+
+        with self.lock:
+            return self.snapshot(job)
+
+    def snapshot(self, job):
+        ''' Copy a job's state so that it can be safely serialised
+        '''
+        res = dict(job)
+        if not isinstance(res['result'], (bool, int, float, str, dict, list, type(None))):
+            res['result'] = str(res['result'])
+        return res
+
+    def evict(self):
+        ''' Drop finished jobs older than the TTL
+
+        Must be called with the lock held
+        '''
+        cutoff = time.time() - self.ttl
+        for job_id in [k for k, (j, d) in self.jobs.items() if j['finished'] and j['finished'] < cutoff]:
+            del self.jobs[job_id]
+
+    def getStats(self):
+        ''' Return the number of jobs in each state
+        '''
+        stats = {}
+        with self.lock:
+            for job, done in self.jobs.values():
+                stats[job['status']] = stats.get(job['status'], 0) + 1
+        return stats
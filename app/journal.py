@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# Schedule journal
+#
+# Records every schedule read and write to a SQLite database so
+# that a restarted process can pick up where it left off, and so
+# that a write interrupted by a crash can be recognised as such
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import sqlite3
+import threading
+import time
+
+
+class ScheduleJournal:
+    ''' An on-disk log of the cid 103 values read from and written
+    to each inverter
+
+    Writes are recorded as pending before the request is placed and
+    then updated with the outcome, so a write which never reached
+    ok or failed was interrupted and the inverter's state is unknown
+
+    Only the most recent keep_per_inverter entries for each inverter
+    are retained
+    '''
+
+    def __init__(self, path, keep_per_inverter=100, compact_every=100, debug=False):
+        self.path = path
+        self.keep = keep_per_inverter
+        self.compact_every = compact_every
+        self.debug = debug
+
+        # The connection is shared between threads, access
+        # to it is serialised by the lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sn TEXT NOT NULL,
+            ts REAL NOT NULL,
+            op TEXT NOT NULL,
+            value TEXT NOT NULL,
+            status TEXT NOT NULL
+            )''')
+        self.db.execute("CREATE INDEX IF NOT EXISTS journal_sn ON journal (sn, id)")
+        self.db.commit()
+
+        self.since_compaction = 0
+        self.stats = {
+            "records" : 0,
+            "compactions" : 0
+            }
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+
+    def record(self, sn, op, value, status):
+        ''' Append an entry, returning its id
+        '''
+        with self.lock:
+            cur = self.db.execute("INSERT INTO journal (sn, ts, op, value, status) VALUES (?, ?, ?, ?, ?)",
+                                  (sn, time.time(), op, value, status))
+            self.db.commit()
+            self.stats['records'] += 1
+            self.since_compaction += 1
+            due = self.since_compaction >= self.compact_every
+
+        if due:
+            self.compact()
+
+        return cur.lastrowid
+
+    def recordRead(self, sn, value):
+        ''' Record a value read from the inverter
+        '''
+        return self.record(sn, "read", value, "ok")
+
+    def beginWrite(self, sn, value):
+        ''' Record that we're about to write value, returning
+        the id to pass to finishWrite
+        '''
+        return self.record(sn, "write", value, "pending")
+
+    def finishWrite(self, entry_id, ok):
+        ''' Record the outcome of a write
+        '''
+        with self.lock:
+            self.db.execute("UPDATE journal SET status = ?, ts = ? WHERE id = ?",
+                            ("ok" if ok else "failed", time.time(), entry_id))
+            self.db.commit()
+
+    def latest(self):
+        ''' Return the most recent entry for each inverter, as a dict
+        keyed by serial
+
+        Each entry is a dict with keys op, value, status and ts
+        '''
+        with self.lock:
+            rows = self.db.execute('''SELECT sn, op, value, status, ts FROM journal
+                WHERE id IN (SELECT MAX(id) FROM journal GROUP BY sn)''').fetchall()
+
+        return {sn : {"op" : op, "value" : value, "status" : status, "ts" : ts}
+                for sn, op, value, status, ts in rows}
+
+    def compact(self):
+        ''' Drop all but the most recent entries for each inverter
+        '''
+        with self.lock:
+            cur = self.db.execute('''DELETE FROM journal WHERE id NOT IN (
+                SELECT id FROM journal AS j WHERE j.sn = journal.sn ORDER BY id DESC LIMIT ?
+                )''', (self.keep,))
+            self.db.commit()
+            self.since_compaction = 0
+            self.stats['compactions'] += 1
+
+        self.printDebug(f'JOURNAL: compacted, removed {cur.rowcount} entries')
+        return cur.rowcount
+
+    def getStats(self):
+        ''' Return counts of records written and compactions run
+        '''
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = self.db.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.db.close()
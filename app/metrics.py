@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Metrics
+#
+# A small, dependency free, registry of counters, gauges and
+# histograms which can be rendered in Prometheus' text
+# exposition format
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import bisect
+import threading
+
+
+class Registry:
+    ''' A collection of metrics
+
+    Collectors are callables which return a list of
+    (name, type, help, [(labels, value), ...]) tuples. They're
+    called at render time, allowing values which are tracked
+    elsewhere to be exposed
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def addCollector(self, fn):
+        with self.lock:
+            self.collectors.append(fn)
+
+    def render(self):
+        ''' Render all metrics in Prometheus text format
+        '''
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+
+        for fn in collectors:
+            for name, mtype, help, samples in fn():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {mtype}")
+                for labels, value in samples:
+                    lines.append(f"{name}{formatLabels(labels)} {formatValue(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def formatLabels(labels):
+    ''' Format a dict of labels as {k="v",...}
+    '''
+    if not labels:
+        return ""
+
+    escaped = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{k}="{v}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    ''' Base class: holds a value per unique set of label values
+    '''
+
+    mtype = "untyped"
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+        if registry is None:
+            registry = REGISTRY
+        if registry:
+            registry.register(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(l, "")) for l in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.mtype}"]
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def render(self):
+        lines = self.header()
+        for key, value in self.samples():
+            lines.append(f"{self.name}{formatLabels(dict(zip(self.labels, key)))} {formatValue(value)}")
+        return lines
+
+
+class Counter(Metric):
+    ''' A value which only goes up
+    '''
+
+    mtype = "counter"
+
+    def inc(self, value=1, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + value
+
+
+class Gauge(Metric):
+    ''' A value which can go up and down
+    '''
+
+    mtype = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+    ''' Counts observations into cumulative buckets
+    '''
+
+    mtype = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def observe(self, value, **labels):
+        k = self.key(labels)
+        with self.lock:
+            if k not in self.values:
+                self.values[k] = {
+                    "buckets" : [0] * len(self.buckets),
+                    "sum" : 0.0,
+                    "count" : 0
+                    }
+            entry = self.values[k]
+
+            # Counts are stored per-bucket and made cumulative at render time
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry['buckets'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = [(k, dict(v, buckets=list(v['buckets']))) for k, v in self.values.items()]
+
+        for key, entry in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry['buckets']):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{formatLabels(dict(labels, le=formatValue(float(bound))))} {cumulative}")
+            lines.append(f"{self.name}_bucket{formatLabels(dict(labels, le='+Inf'))} {entry['count']}")
+            lines.append(f"{self.name}_sum{formatLabels(labels)} {formatValue(entry['sum'])}")
+            lines.append(f"{self.name}_count{formatLabels(labels)} {entry['count']}")
+        return lines
+
+
+# The default registry
+REGISTRY = Registry()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+#
+# Tariff planner
+#
+# Works out when to charge and discharge the battery given a
+# day's import (and optionally export) prices, producing a
+# timings dict that can be passed straight to
+# SolisCloud.setChargeDischargeTimings
+#
+# Requires numpy (pip install numpy)
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import json
+import math
+import os
+import sys
+
+from slots import SlotPacker
+
+try:
+    import numpy as np
+except ImportError:
+    np = False
+
+
+class TariffPlanner:
+    ''' Plan a charge/discharge cycle for each day of price data
+
+    Prices are given as an array whose last axis covers a single
+    day at a fixed resolution (48 entries for half-hourly prices).
+    Any leading axes (days, sites etc) are planned independently,
+    so a week of prices for 10 sites can be passed as an array of
+    shape (10, 7, 48) and planned in one go.
+
+    For each day the planner finds the single charge/discharge cycle
+    that maximises the value of the energy moved: it charges during
+    the cheapest periods before some point in the day and discharges
+    during the most valuable periods after it, for as long as doing so
+    is worth more than min_spread per kWh after losses. Every possible
+    split of the day is evaluated at once using array operations.
+
+    How much energy a period moves depends on the charge or discharge
+    current, and no more than capacity_kwh is moved, so the last
+    period of each may only be partially used.
+    '''
+
+    def __init__(self, capacity_kwh, charge_current=50, discharge_current=50, voltage=51.2,
+                 efficiency=0.9, min_spread=0):
+        if not np:
+            raise ImportError("TariffPlanner requires numpy: pip install numpy")
+
+        self.capacity_kwh = capacity_kwh
+        self.charge_current = charge_current
+        self.discharge_current = discharge_current
+        self.voltage = voltage
+        self.efficiency = efficiency
+        self.min_spread = min_spread
+
+    def plan(self, import_prices, export_prices=None):
+        ''' Plan charging and discharging
+
+        export_prices is the value of a kWh discharged from the battery.
+        It defaults to the import price, which is the saving made by
+        powering the house from the battery rather than the grid
+
+        Returns a dict of
+            charge: boolean array, True where the battery should charge
+            discharge: boolean array, True where the battery should discharge
+            charge_kwh, discharge_kwh: arrays of the energy moved into/out
+                of the battery in each period
+            value: array of the expected value of each day's cycle
+        '''
+        imp = np.asarray(import_prices, dtype=float)
+        exp = imp if export_prices is None else np.asarray(export_prices, dtype=float)
+        if imp.shape != exp.shape:
+            raise ValueError(f"import prices {imp.shape} and export prices {exp.shape} differ in shape")
+
+        n = imp.shape[-1]
+        charge_kwh = self.periodEnergy(n, self.charge_current)
+        discharge_kwh = self.periodEnergy(n, self.discharge_current)
+        max_charge = min(n, math.ceil(self.capacity_kwh / charge_kwh))
+        max_discharge = min(n, math.ceil(self.capacity_kwh / discharge_kwh))
+
+        # before[s, i] is True if period i falls before split point s.
+        # There are n + 1 split points: 0 means discharge all day, n
+        # means charge all day
+        before = np.arange(n)[None, :] < np.arange(n + 1)[:, None]
+
+        # For each split point, rank the periods before it by price
+        # (cheapest first) and those after it by value (highest first)
+        # Periods on the wrong side of the split are pushed to the end
+        buy = np.where(before, imp[..., None, :], np.inf)
+        sell = np.where(before, -np.inf, exp[..., None, :] * self.efficiency)
+        buy_order = np.argsort(buy, axis=-1)[..., :max_charge]
+        sell_order = np.argsort(-sell, axis=-1)[..., :max_discharge]
+        bought = np.take_along_axis(buy, buy_order, axis=-1)
+        sold = np.take_along_axis(sell, sell_order, axis=-1)
+
+        # Split the energy moved (0 to capacity, or as much as the day
+        # allows) into segments, within each of which a single charge
+        # period and a single discharge period are in use. Periods are
+        # all the same size, so these boundaries are the same for every
+        # day and split point
+        limit = min(self.capacity_kwh, max_charge * charge_kwh, max_discharge * discharge_kwh)
+        bounds = np.unique(np.concatenate((
+            np.arange(max_charge + 1) * charge_kwh,
+            np.arange(max_discharge + 1) * discharge_kwh,
+            [limit]
+            )))
+        bounds = bounds[bounds <= limit]
+        widths = np.diff(bounds)
+        mids = bounds[:-1] + widths / 2
+
+        # The gain per kWh from each segment only ever decreases (prices
+        # paid rise, values received fall), so it's worth using every
+        # segment with a positive gain
+        gain = (sold[..., (mids // discharge_kwh).astype(int)]
+                - bought[..., (mids // charge_kwh).astype(int)]
+                - self.min_spread)
+        use = gain > 0
+        value = np.where(use, gain * widths, 0).sum(axis=-1)
+        energy = np.where(use, widths, 0).sum(axis=-1)
+
+        # Pick the best split point
+        best = np.argmax(value, axis=-1)[..., None]
+        energy = np.take_along_axis(energy, best, axis=-1)
+        buy_order = np.take_along_axis(buy_order, best[..., None], axis=-2)[..., 0, :]
+        sell_order = np.take_along_axis(sell_order, best[..., None], axis=-2)[..., 0, :]
+
+        # Fill the k-th cheapest (most valuable) period before moving on to
+        # the next. Each period appears at most once in an ordering, so
+        # scattering assigns each its energy
+        charged = self.fillPeriods(energy, charge_kwh, max_charge)
+        discharged = self.fillPeriods(energy, discharge_kwh, max_discharge)
+        charge = np.zeros(imp.shape)
+        discharge = np.zeros(imp.shape)
+        np.put_along_axis(charge, buy_order, charged, axis=-1)
+        np.put_along_axis(discharge, sell_order, discharged, axis=-1)
+
+        return {
+            "charge" : charge > 0,
+            "discharge" : discharge > 0,
+            "charge_kwh" : charge,
+            "discharge_kwh" : discharge,
+            "value" : np.take_along_axis(value, best, axis=-1)[..., 0]
+            }
+
+    def fillPeriods(self, energy, period_kwh, periods):
+        ''' Share energy (an array with a trailing axis of length 1)
+        across up to `periods` periods of period_kwh each, in order
+        '''
+        filled = np.clip(energy - np.arange(periods) * period_kwh, 0, period_kwh)
+
+        # Don't turn floating point noise into a sliver of a period
+        return np.where(filled > 1e-9, filled, 0)
+
+    def periodEnergy(self, periods_per_day, current=None):
+        ''' Energy (kWh) moved into or out of the battery during one
+        period at current (defaults to the charge current)
+        '''
+        if current is None:
+            current = self.charge_current
+        return current * self.voltage / 1000 * (24 / periods_per_day)
+
+    def toPacker(self, plan, index=()):
+        ''' Load one day of a plan into a SlotPacker
+
+        A partially used period shortens the window that it's part of
+        (from the end) by the time that it isn't needed for
+        '''
+        packer = SlotPacker()
+        currents = {"charge" : self.charge_current, "discharge" : self.discharge_current}
+        for action in ["charge", "discharge"]:
+            mask = plan[action][index]
+            minutes = 1440 // mask.shape[-1]
+            used = plan[f"{action}_kwh"][index] / self.periodEnergy(mask.shape[-1], currents[action])
+
+            # Find the start and end of each run of periods
+            edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+            for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+                duration = max(1, round(float(used[start:end].sum()) * minutes))
+                packer.add(action, int(start) * minutes, int(start) * minutes + duration)
+
+        return packer
+
+    def toTimings(self, plan, index=()):
+        ''' Build a timings dict from one day of a plan
+
+        index selects the day when the plan covers more than one
+        (for example, 0 for the first day, or (site, day))
+
+        If there are more windows than slots, the closest are merged.
+        All charging comes before all discharging, so this can always
+        be done without the merged windows overlapping
+
+        The result replaces the whole schedule, including the
+        slot used for manual control
+        '''
+        timings, deferred = self.toPacker(plan, index).toTimings(
+            self.charge_current, self.discharge_current, overflow="merge")
+        return timings
+
+
+def plannerFromEnv():
+    ''' Build a TariffPlanner based on environment variables
+    '''
+    return TariffPlanner(
+        float(os.getenv("BATTERY_CAPACITY_KWH", 10)),
+        int(os.getenv("PLAN_CHARGE_CURRENT", 50)),
+        int(os.getenv("PLAN_DISCHARGE_CURRENT", 50)),
+        float(os.getenv("BATTERY_VOLTAGE", 51.2)),
+        float(os.getenv("BATTERY_EFFICIENCY", 0.9)),
+        float(os.getenv("PLAN_MIN_SPREAD", 0))
+        )
+
+
+if __name__ == "__main__":
+    # Plan from a JSON file containing {"import": [...], "export": [...]}
+    # and print (or, with --apply, write) the resulting schedule
+    import soliscloud_control
+
+    DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} prices.json [--apply]")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as fh:
+        prices = json.load(fh)
+
+    planner = plannerFromEnv()
+    plan = planner.plan(prices['import'], prices.get('export', None))
+    timings = planner.toTimings(plan)
+    print(json.dumps(timings, indent=2))
+    print(f"Expected value: {float(plan['value']):.2f}")
+
+    if "--apply" in sys.argv:
+        config = soliscloud_control.configFromEnv()
+        soliscloud = soliscloud_control.SolisCloud(config, debug=DEBUG)
+        if not soliscloud.setChargeDischargeTimings(config['inverter'], timings):
+            print("Failed to apply schedule")
+            sys.exit(1)
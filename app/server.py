@@ -39,10 +39,20 @@ TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF TH
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
+import hashlib
+import math
+import metrics
 import os
 import soliscloud_control
+import time
 
-from flask import Flask, request, Response
+from admission import AdmissionController, Overloaded
+from command_queue import CommandQueue
+from events import EventBroadcaster, formatSSE
+from idempotency import IdempotencyCache
+from jobs import JobManager
+
+from flask import Flask, request, Response, jsonify, stream_with_context
 from flask_cors import CORS
 
 app = Flask(__name__)
@@ -57,6 +67,143 @@ def version():
 
     return "Soliscloud Control - no auth headers\n"    
 
+@app.route('/health')
+def health():
+    ''' Report whether the server is able to accept control
+    operations, along with the depth of its queues
+    
+    This doesn't require auth, so that it can be used by health
+    checks. It returns a 503 whilst operations would be refused
+    '''
+    admission_stats = admission.getStats()
+    circuit = soliscloud.breaker.state()
+    
+    # Whilst the half-open trial is in flight, everything else is refused
+    if soliscloud.breaker.refusing():
+        status = "upstream_failing"
+    elif admission_stats['pending'] >= admission_stats['max_pending'] or admission_stats['upstream_wait'] > admission.max_wait:
+        status = "overloaded"
+    elif admission_stats['pending'] or admission_stats['upstream_wait']:
+        status = "busy"
+    else:
+        status = "ok"
+    
+    return jsonify({
+        "status" : status,
+        "pending" : admission_stats['pending'],
+        "max_pending" : admission_stats['max_pending'],
+        "upstream_wait" : admission_stats['upstream_wait'],
+        "upstream_queued" : soliscloud.scheduler.waiting(),
+        "circuit" : circuit,
+        "jobs" : jobs.getStats()
+        }), 503 if status in ["overloaded", "upstream_failing"] else 200
+
+@app.route('/api/v1/stats')
+def stats():
+    ''' Expose internal counters
+    '''
+    if not checkAuth(request.authorization):
+        return Response(status=403)
+    
+    return jsonify({
+        "schedule_cache" : soliscloud.getCacheStats(),
+        "writes" : soliscloud.getWriteStats(),
+        "transport" : soliscloud.transport.getStats(),
+        "commands" : commands.getStats(),
+        "jobs" : jobs.getStats(),
+        "journal" : soliscloud.getJournalStats(),
+        "scheduler" : soliscloud.scheduler.getStats(),
+        "ratelimiter" : soliscloud.ratelimiter.getStats(),
+        "events" : events.getStats(),
+        "admission" : admission.getStats(),
+        "idempotency" : idempotency.getStats()
+        })
+
+@app.route('/metrics')
+def prometheusMetrics():
+    ''' Expose metrics in Prometheus format
+    '''
+    if not checkAuth(request.authorization):
+        return Response(status=403)
+    
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/api/v1/schedule')
+def getSchedule():
+    ''' Return the current charge/discharge schedule
+    
+    This is served from a snapshot which is refreshed, at most,
+    every SCHEDULE_MAX_AGE seconds, so any number of clients can
+    poll it without costing additional upstream calls
+    '''
+    if not checkAuth(request.authorization):
+        return Response(status=403)
+    
+    snapshot = soliscloud.getScheduleSnapshot(config['inverter'], SCHEDULE_MAX_AGE)
+    if not snapshot:
+        return Response(status=502)
+    
+    # The value string describes the schedule in its entirety
+    etag = hashlib.sha1(snapshot['value'].encode()).hexdigest()[:20]
+    age = max(0, time.time() - snapshot['fetched'])
+    
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify({
+            "inverter" : config['inverter'],
+            "schedule" : snapshot['timings'],
+            "value" : snapshot['value'],
+            "fetched" : snapshot['fetched'],
+            "age" : round(age, 3)
+            })
+    
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = f"private, max-age={max(0, int(SCHEDULE_MAX_AGE - age))}"
+    return resp
+
+@app.route('/api/v1/events')
+def eventStream():
+    ''' Stream schedule changes and command progress as
+    Server-Sent Events
+    
+    Clients which reconnect with a Last-Event-ID header are sent
+    any retained events that they missed
+    '''
+    if not checkAuth(request.authorization):
+        return Response(status=403)
+    
+    try:
+        last_id = request.headers.get("Last-Event-ID", None)
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return Response(status=400)
+    
+    sub = events.subscribe(last_id)
+    if not sub:
+        # Every stream ties up a server thread, so they're capped
+        return Response(status=503, headers={"Retry-After": str(EVENTS_HEARTBEAT)})
+    
+    def generate():
+        try:
+            # Tell EventSource clients how long to wait before reconnecting
+            yield "retry: 3000\n\n"
+            while True:
+                entry = sub.get(EVENTS_HEARTBEAT)
+                if entry is False:
+                    # Closed (most likely because the client fell behind)
+                    return
+                if entry is None:
+                    # A comment line, so that dead connections are noticed
+                    yield ": keepalive\n\n"
+                    continue
+                yield formatSSE(entry)
+        finally:
+            events.unsubscribe(sub)
+    
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control" : "no-cache", "X-Accel-Buffering" : "no"})
+
 @app.route('/api/v1/setCurrent', methods=['POST'])
 def setCurrent():
     ''' Change the configured current but don't change schedules
@@ -69,10 +216,7 @@ def setCurrent():
     if not rates:
         return Response(status=400)
     
-    if soliscloud.setCurrents(rates):
-        return Response(status=200)
-    else:
-        return Response(status=502)
+    return dispatch("setCurrent", commands.setCurrents, rates)
 
 @app.route('/api/v1/startCharge', methods=['POST'])
 def startCharge():
@@ -83,7 +227,6 @@ def startCharge():
         return Response(status=403)    
     
     hours = 3
-    exact = False
     
     # Read the request body if present
     req = request.get_json(silent=True)
@@ -91,22 +234,11 @@ def startCharge():
     # Get desired charge/discharge rates if provided
     rates = getCurrents(req)
     
-    # Was there valid json in the request
-    if req: 
-        if "end" in req:
-            # Split out the hours and minutes
-            t1 = req["end"].split(" ")[1]
-            t2 = t1.split(":")
-            exact = {
-                "hour" : int(t2[0]),
-                "minute" : int(t2[1])
-                }
+    # Get the end time, if provided
+    exact = getEnd(req)
     
     # TODO check if hours are specified
-    if soliscloud.startCharge(hours, exact, rates):
-        return Response(status=200)
-    else:
-        return Response(status=502)
+    return dispatch("startCharge", commands.startCharge, hours, exact, rates)
 
 @app.route('/api/v1/startDischarge', methods=['POST'])
 def startDischarge():
@@ -115,17 +247,19 @@ def startDischarge():
     if not checkAuth(request.authorization):
         return Response(status=403)    
     
+    hours = 3
+    
     # Read the request body if present
     req = request.get_json(silent=True)
     
     # Get desired charge/discharge rates if provided
     rates = getCurrents(req)
     
+    # Get the end time, if provided
+    exact = getEnd(req)
+    
     # TODO check if hours are specified
-    if soliscloud.startDischarge(rates):
-        return Response(status=200)
-    else:
-        return Response(status=502)
+    return dispatch("startDischarge", commands.startDischarge, hours, exact, rates)
 
 @app.route('/api/v1/stopCharge', methods=['POST'])
 def stopCharge():
@@ -141,10 +275,7 @@ def stopCharge():
     rates = getCurrents(req)
     
     # TODO check if hours are specified
-    if soliscloud.stopCharge(rates):
-        return Response(status=200)
-    else:
-        return Response(status=502)
+    return dispatch("stopCharge", commands.stopCharge, rates)
 
 @app.route('/api/v1/stopDischarge', methods=['POST'])
 def stopDischarge():
@@ -160,10 +291,46 @@ def stopDischarge():
     rates = getCurrents(req)
     
     # TODO check if hours are specified
-    if soliscloud.stopDischarge(rates):
-        return Response(status=200)
-    else:
-        return Response(status=502)
+    return dispatch("stopDischarge", commands.stopDischarge, rates)
+
+
+@app.route('/api/v1/jobs/<job_id>')
+def getJob(job_id):
+    ''' Report the status of a background job
+    
+    If the wait query string parameter is provided, block for up
+    to that many seconds for the job to complete
+    '''
+    if not checkAuth(request.authorization):
+        return Response(status=403)
+    
+    try:
+        wait = min(float(request.args.get("wait", 0)), JOB_MAX_WAIT)
+    except ValueError:
+        return Response(status=400)
+    
+    job = jobs.get(job_id, wait)
+    if not job:
+        return Response(status=404)
+    
+    return jsonify(job)
+
+
+@app.errorhandler(Overloaded)
+@app.errorhandler(soliscloud_control.RateLimitExceeded)
+def rateLimitExceeded(e):
+    ''' We're already at capacity, or couldn't get a slot within
+    the upstream rate limit in a reasonable time. Tell the client
+    when to come back
+    '''
+    return Response(status=429, headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
+
+@app.errorhandler(soliscloud_control.CircuitOpen)
+def circuitOpen(e):
+    ''' The upstream is currently failing
+    '''
+    return Response(status=503, headers={"Retry-After": str(math.ceil(e.retry_after))})
 
 
 def checkAuth(auth):
@@ -184,6 +351,209 @@ def checkAuth(auth):
     return False
 
 
+def collectStats():
+    ''' Metrics collector: expose the counters tracked by the
+    various components
+    '''
+    cache = soliscloud.getCacheStats()
+    writes = soliscloud.getWriteStats()
+    transport = soliscloud.transport.getStats()
+    queue = commands.getStats()
+    job_stats = jobs.getStats()
+    event_stats = events.getStats()
+    admission_stats = admission.getStats()
+    idempotency_stats = idempotency.getStats()
+    
+    return [
+        ("soliscloud_schedule_cache_total", "counter", "Schedule cache lookups",
+            [({"result" : "hit"}, cache['hits']), ({"result" : "miss"}, cache['misses'])]),
+        ("soliscloud_writes_total", "counter", "Control writes placed or elided",
+            [({"result" : "written"}, writes['writes']), ({"result" : "elided"}, writes['elided'])]),
+        ("soliscloud_connections_opened_total", "counter", "Connections opened to the API",
+            [({}, transport['connections_opened'])]),
+        ("soliscloud_connect_seconds_total", "counter", "Time spent establishing connections to the API",
+            [({}, transport['connect_time'])]),
+        ("soliscloud_circuit_open", "gauge", "Whether the circuit breaker is currently refusing requests",
+            [({}, 0 if soliscloud.breaker.state() == "closed" else 1)]),
+        ("soliscloud_ratelimit_next_slot_seconds", "gauge", "Time until the next rate limit slot is free",
+            [({}, soliscloud.ratelimiter.timeUntilNextSlot())]),
+        ("soliscloud_commands_pending", "gauge", "Commands waiting to be coalesced and written",
+            [({}, queue['pending'])]),
+        ("soliscloud_commands_total", "counter", "Control commands received",
+            [({}, queue['commands'])]),
+        ("soliscloud_jobs", "gauge", "Background jobs by status",
+            [({"status" : k}, v) for k, v in job_stats.items()]),
+        ("soliscloud_event_subscribers", "gauge", "Clients subscribed to /api/v1/events",
+            [({}, event_stats['subscribers'])]),
+        ("soliscloud_events_published_total", "counter", "Events published to subscribers",
+            [({}, event_stats['published'])]),
+        ("soliscloud_event_overflows_total", "counter", "Subscribers disconnected for falling behind",
+            [({}, event_stats['overflowed'])]),
+        ("soliscloud_admission_pending", "gauge", "Control operations admitted and not yet complete",
+            [({}, admission_stats['pending'])]),
+        ("soliscloud_admission_rejected_total", "counter", "Control operations refused with a 429",
+            [({"reason" : "queue_full"}, admission_stats['rejected_queue_full']),
+             ({"reason" : "upstream"}, admission_stats['rejected_upstream'])]),
+        ("soliscloud_idempotent_replays_total", "counter", "Duplicate requests answered with a stored response",
+            [({}, idempotency_stats['replayed'])])
+        ]
+
+
+def dispatch(operation, fn, *args):
+    ''' Run a control operation and build the response
+    
+    If the request carries an Idempotency-Key, a retry of an
+    operation which has already succeeded receives the original
+    response rather than running it again (see idempotent)
+    '''
+    key = request.headers.get("Idempotency-Key", None)
+    if key is not None:
+        return idempotent(key, operation, fn, *args)
+    
+    return runOperation(operation, fn, *args)
+
+
+def idempotent(key, operation, fn, *args):
+    ''' Run an operation at most once per Idempotency-Key
+    
+    A duplicate of a completed request gets the stored response. A
+    duplicate of one still in progress gets an immediate 409 with a
+    Retry-After, rather than holding a thread (which would get around
+    admission control). Only successful responses are stored, so a
+    request which failed or was refused is run again on retry
+    '''
+    if not key or len(key) > 255:
+        return Response(status=400)
+    
+    # Keys are per-endpoint, and reusing one with a different request
+    # body is a client error rather than a retry
+    fingerprint = hashlib.sha1(request.get_data()).hexdigest()
+    scoped_key = f"{request.path}:{key}"
+    
+    while True:
+        entry, owner = idempotency.begin(scoped_key, fingerprint)
+        if owner:
+            break
+        
+        if entry['fingerprint'] != fingerprint:
+            return Response(status=422)
+        
+        result = idempotency.outcome(entry)
+        if result is None:
+            # The original is still running, suggest trying again
+            # once it's likely to have finished
+            remaining = admission.avg_duration - (time.time() - entry['created'])
+            return Response(status=409, headers={"Retry-After": str(max(1, math.ceil(remaining)))})
+        
+        if result:
+            status, headers, body = result
+            return Response(body, status=status, headers=headers + [("Idempotent-Replayed", "true")])
+        
+        # The original was abandoned, so go again
+    
+    try:
+        resp = app.make_response(runOperation(operation, fn, *args))
+    except Exception:
+        idempotency.abandon(entry)
+        raise
+    
+    if 200 <= resp.status_code < 300:
+        headers = [(k, v) for k, v in resp.headers.items() if k in ["Content-Type", "Location"]]
+        idempotency.complete(entry, (resp.status_code, headers, resp.get_data()))
+    else:
+        idempotency.abandon(entry)
+    
+    return resp
+
+
+def runOperation(operation, fn, *args):
+    ''' Admit and run (or queue) a control operation
+    
+    If the client has opted in (by sending Prefer: respond-async or
+    setting the async query string parameter) the operation is
+    handed to the job pool and a 202 is returned immediately
+    
+    Operations which the server doesn't have capacity for are
+    refused (see rateLimitExceeded) before any work is done
+    '''
+    admitted = admission.admit(operation)
+    
+    if wantsAsync(request):
+        job = jobs.submit(operation, admittedCommand, admitted, operation, fn, *args)
+        return jsonify(job), 202, {"Location" : f"/api/v1/jobs/{job['id']}"}
+    
+    if admittedCommand(admitted, operation, fn, *args):
+        return Response(status=200)
+    else:
+        return Response(status=502)
+
+
+def admittedCommand(admitted, operation, fn, *args):
+    ''' Run an admitted operation, releasing its capacity once done
+    '''
+    try:
+        return publishCommand(operation, fn, *args)
+    finally:
+        admission.release(admitted)
+
+
+def publishCommand(operation, fn, *args):
+    ''' Run a control operation, publishing events when it starts
+    and when it completes
+    '''
+    command_id = events.publish("command_started", {"operation" : operation})
+    start = time.time()
+    data = {"operation" : operation, "command_id" : command_id}
+    
+    try:
+        result = fn(*args)
+    except Exception as e:
+        data.update({"success" : False, "error" : str(e), "elapsed" : time.time() - start})
+        events.publish("command_completed", data)
+        raise
+    
+    data.update({"success" : bool(result), "error" : False, "elapsed" : time.time() - start})
+    events.publish("command_completed", data)
+    return result
+
+
+def publishScheduleChange(sn, timings, value, previous):
+    ''' Schedule listener: publish changes observed by reads or writes
+    '''
+    timings.pop("raw", None)
+    events.publish("schedule_changed", {
+        "inverter" : sn,
+        "schedule" : timings,
+        "value" : value,
+        "previous" : previous
+        })
+
+
+def wantsAsync(req):
+    ''' Check whether the client has asked for the request
+    to be processed in the background
+    '''
+    if "respond-async" in req.headers.get("Prefer", "").lower():
+        return True
+    
+    return req.args.get("async", "false").lower() in ["true", "1", "yes"]
+
+
+def getEnd(req):
+    ''' Check if the request provides an end time
+    '''
+    if not req or "end" not in req:
+        return False
+    
+    # Split out the hours and minutes
+    t1 = req["end"].split(" ")[1]
+    t2 = t1.split(":")
+    return {
+        "hour" : int(t2[0]),
+        "minute" : int(t2[1])
+        }
+
+
 def getCurrents(req):
     ''' Check if the request provides currents
     '''
@@ -202,8 +572,15 @@ def getCurrents(req):
     return rates
 
 
-if __name__ == "__main__":
-
+def setup():
+    ''' Read configuration and create the objects that the
+    endpoints rely on
+    
+    This is called when run directly, and by wsgi.py when the
+    app is being served by a WSGI server
+    '''
+    global DEBUG, DO_AUTH, USER, PASS, JOB_MAX_WAIT, SCHEDULE_MAX_AGE, EVENTS_HEARTBEAT, config, soliscloud, commands, jobs, events, admission, idempotency
+    
     # Are we running in debug mode?
     DEBUG = os.getenv("DEBUG", "false").lower() == "true"
     DO_AUTH = os.getenv("DO_AUTH", "false").lower() == "true"
@@ -219,4 +596,64 @@ if __name__ == "__main__":
     config = soliscloud_control.configFromEnv()    
     soliscloud = soliscloud_control.SolisCloud(config, debug=DEBUG)
     
-    app.run(host="0.0.0.0", port=8080, debug=DEBUG)
+    # Pushes schedule changes and command progress to /api/v1/events subscribers
+    events = EventBroadcaster(
+        int(os.getenv("EVENTS_BUFFER", 100)),
+        int(os.getenv("EVENTS_HISTORY", 100)),
+        int(os.getenv("EVENTS_MAX_SUBSCRIBERS", 8)),
+        debug=DEBUG
+        )
+    EVENTS_HEARTBEAT = int(os.getenv("EVENTS_HEARTBEAT", 15))
+    soliscloud.addScheduleListener(publishScheduleChange)
+    
+    # Keep the schedule cache warm if configured to
+    soliscloud.startScheduleRefresher()
+    
+    # Control commands are queued so that those arriving in
+    # quick succession can be merged into a single write
+    commands = CommandQueue(soliscloud, float(os.getenv("COALESCE_WINDOW", 0.5)), debug=DEBUG)
+    
+    # Worker pool for requests which ask to be processed in the background
+    jobs = JobManager(int(os.getenv("JOB_WORKERS", 4)), int(os.getenv("JOB_TTL", 3600)), debug=DEBUG)
+    JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", 30))
+    
+    # Responses to requests carrying an Idempotency-Key
+    idempotency = IdempotencyCache(
+        int(os.getenv("IDEMPOTENCY_MAX_KEYS", 1000)),
+        int(os.getenv("IDEMPOTENCY_TTL", 86400)),
+        debug=DEBUG
+        )
+    
+    # Bounds the operations in progress (including background jobs),
+    # refusing those beyond it with a 429
+    admission = AdmissionController(
+        soliscloud.scheduler,
+        int(os.getenv("MAX_PENDING_OPERATIONS", 8)),
+        float(os.getenv("ADMISSION_MAX_WAIT", config['max_ratelimit_wait'])),
+        debug=DEBUG
+        )
+    
+    # How stale a schedule served by /api/v1/schedule is allowed to be
+    SCHEDULE_MAX_AGE = float(os.getenv("SCHEDULE_MAX_AGE", 30))
+    
+    metrics.REGISTRY.addCollector(collectStats)
+    
+    return app
+
+
+if __name__ == "__main__":
+    
+    setup()
+    
+    LISTEN_HOST = os.getenv("LISTEN_HOST", "0.0.0.0")
+    LISTEN_PORT = int(os.getenv("LISTEN_PORT", 8080))
+    
+    if os.getenv("SERVER_MODE", "development").lower() == "production":
+        # Serve using waitress, a multi-threaded production WSGI server
+        #
+        # Threads share a single SolisCloud instance (and so a single
+        # rate limit budget and command queue)
+        from waitress import serve
+        serve(app, host=LISTEN_HOST, port=LISTEN_PORT, threads=int(os.getenv("SERVER_THREADS", 16)))
+    else:
+        app.run(host=LISTEN_HOST, port=LISTEN_PORT, debug=DEBUG, threaded=True)
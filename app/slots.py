@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+#
+# Slot packing
+#
+# The cid 103 schedule has three charge and three discharge slots.
+# This takes a set of desired charge/discharge windows, merges
+# those that overlap or touch and packs them into the slots so
+# that several hours of behaviour can be set with a single write
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import bisect
+import datetime
+
+
+ACTIONS = ["charge", "discharge"]
+
+UNUSED = "00:00-00:00"
+
+MINUTES_PER_DAY = 1440
+
+
+def toMinutes(t):
+    ''' Convert a time of day to minutes past midnight
+
+    t may be a "HH:MM" string, a datetime/time or a number of minutes
+    '''
+    if isinstance(t, (datetime.datetime, datetime.time)):
+        return t.hour * 60 + t.minute
+
+    if isinstance(t, str):
+        h, m = t.split(":")
+        return int(h) * 60 + int(m)
+
+    return int(t)
+
+
+def formatTimeRange(start, end):
+    ''' Format a range of minutes past midnight as HH:MM-HH:MM
+    '''
+    if end >= MINUTES_PER_DAY:
+        # A window running until midnight ends at 00:00, unless it
+        # also started then (which would read as an unused slot)
+        end = MINUTES_PER_DAY - 1 if start == 0 else 0
+    return f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}"
+
+
+class IntervalIndex:
+    ''' A sorted set of non-overlapping [start, end) intervals
+
+    Intervals which overlap or touch are merged as they're added
+    '''
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(list(zip(self.starts, self.ends)))
+
+    def overlapping(self, start, end):
+        ''' Return the positions of intervals which overlap [start, end)
+        '''
+        # The first interval which ends after start, up to the
+        # first which starts at or after end
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_left(self.starts, end)
+        return range(first, last)
+
+    def overlaps(self, start, end):
+        return len(self.overlapping(start, end)) > 0
+
+    def add(self, start, end):
+        ''' Add an interval, merging it with any that it overlaps or touches
+
+        Returns the resulting (merged) interval
+        '''
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+        return start, end
+
+    def gaps(self):
+        ''' Return (size, position) for the gap after each interval
+        but the last
+        '''
+        return [(self.starts[i + 1] - self.ends[i], i) for i in range(len(self.starts) - 1)]
+
+    def mergeAt(self, i):
+        ''' Merge the interval at position i with the next one,
+        absorbing the gap between them
+        '''
+        self.ends[i:i + 2] = [self.ends[i + 1]]
+        del self.starts[i + 1]
+
+
+class SlotPacker:
+    ''' Collect charge and discharge windows and pack them into
+    the schedule's slots
+
+    Windows are times of day: the schedule repeats daily. A window
+    which crosses midnight is split in two
+    '''
+
+    def __init__(self, max_slots=3):
+        self.max_slots = max_slots
+        self.windows = {a : IntervalIndex() for a in ACTIONS}
+
+    def add(self, action, start, end):
+        ''' Add a window, merging it with any overlapping or adjacent
+        window for the same action
+
+        A window which starts and ends at the same time is empty, and
+        ignored. An end of 00:00 means midnight, as does 24:00
+
+        Raises ValueError if it overlaps a window for the other action
+        '''
+        if action not in ACTIONS:
+            raise ValueError(f'Unknown action {action}, should be one of {ACTIONS}')
+
+        start = toMinutes(start)
+        end = toMinutes(end)
+        if not 0 <= start < MINUTES_PER_DAY or not 0 <= end <= MINUTES_PER_DAY:
+            raise ValueError(f'{action} window {start}-{end} (minutes past midnight) is outside of a day')
+
+        if start == end:
+            # Empty, like an unused slot (00:00-00:00). A whole day
+            # has to be given as 00:00-23:59 (or an end of 24:00)
+            return self
+
+        if end == 0:
+            end = MINUTES_PER_DAY
+
+        if end < start:
+            # Crosses midnight
+            ranges = [(start, MINUTES_PER_DAY), (0, end)]
+        else:
+            ranges = [(start, end)]
+
+        other = self.windows[ACTIONS[1 - ACTIONS.index(action)]]
+        for s, e in ranges:
+            if other.overlaps(s, e):
+                raise ValueError(f'{action} window {formatTimeRange(s, e)} overlaps a window for the opposite action')
+
+        for s, e in ranges:
+            if s < e:
+                self.windows[action].add(s, e)
+
+        return self
+
+    def addWindows(self, windows):
+        ''' Add a list of dicts with keys action, start and end
+        '''
+        for w in windows:
+            self.add(w['action'], w['start'], w['end'])
+        return self
+
+    def pack(self, now=None, overflow="defer"):
+        ''' Fit the windows into max_slots slots per action
+
+        Where there are too many windows, overflow determines what happens
+            defer: the windows starting soonest after now are used, the
+                   others are returned so that they can be written later
+            merge: the windows separated by the smallest gaps are merged
+                   (so the gap is included), provided that doesn't
+                   overlap a window for the opposite action
+
+        Returns a tuple of a slots dict (as used in a timings dict)
+        and a list of deferred windows
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        now = toMinutes(now)
+
+        packed = {}
+        deferred = []
+        for i, action in enumerate(ACTIONS):
+            index = self.windows[action]
+            if overflow == "merge":
+                self.mergeToFit(index, self.windows[ACTIONS[1 - i]])
+
+            # Order by how soon each window starts, counting one that's
+            # already in progress as starting now
+            windows = sorted(index, key=lambda w: 0 if w[0] <= now < w[1] else (w[0] - now) % MINUTES_PER_DAY)
+            packed[action] = sorted(windows[:self.max_slots])
+            deferred += [{"action" : action, "start" : s, "end" : e} for s, e in windows[self.max_slots:]]
+
+        slots = {}
+        for i in range(self.max_slots):
+            slots[f"slot{i + 1}"] = {
+                action : formatTimeRange(*packed[action][i]) if i < len(packed[action]) else UNUSED
+                for action in ACTIONS
+                }
+
+        return slots, deferred
+
+    def mergeToFit(self, index, other):
+        ''' Merge the windows in index, closest first, until they fit
+        '''
+        while len(index) > self.max_slots:
+            candidates = [(gap, i) for gap, i in sorted(index.gaps())
+                          if not other.overlaps(index.ends[i], index.starts[i + 1])]
+            if not candidates:
+                return
+            index.mergeAt(candidates[0][1])
+
+    def toTimings(self, charge_current, discharge_current, now=None, overflow="defer"):
+        ''' Build a timings dict, ready for setChargeDischargeTimings
+
+        Returns a tuple of timings and deferred windows
+        '''
+        slots, deferred = self.pack(now, overflow)
+        return {
+            "charge_current" : str(charge_current),
+            "discharge_current" : str(discharge_current),
+            "slots" : slots
+            }, deferred
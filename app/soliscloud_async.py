@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+#
+# asyncio interface to Soliscloud's control api
+#
+# This mirrors the API of SolisCloud in soliscloud_control
+# but uses aiohttp so that calls can be awaited rather than
+# tying up a thread each
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import asyncio
+import os
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = False
+
+from soliscloud_control import (SolisCloud, SolisCloudError, RateLimitExceeded, configFromEnv, endpointName,
+    PRIORITY_BACKGROUND, PRIORITY_READ_BEFORE_WRITE,
+    REQUEST_LATENCY, REQUESTS_IN_FLIGHT, RATELIMIT_WAIT, RATELIMIT_REJECTED, RETRIES)
+from slots import SlotPacker
+
+
+class AsyncSolisCloud(SolisCloud):
+    ''' asyncio version of SolisCloud
+
+    Request signing, schedule parsing and caching are inherited from
+    SolisCloud - only the methods which perform I/O differ, and those
+    are coroutines.
+
+    Use as an async context manager (or call close()) so that the
+    underlying connection pool is released
+    '''
+
+    def __init__(self, config, session=False, debug=False, ratelimiter=False, journal=False, scheduler=False):
+        if not aiohttp:
+            raise ImportError("AsyncSolisCloud requires aiohttp: pip install aiohttp")
+
+        super().__init__(config, session=session, debug=debug, ratelimiter=ratelimiter, journal=journal,
+                         scheduler=scheduler)
+
+        # Serialise read-modify-write cycles so that concurrent
+        # calls don't overwrite each other's changes
+        self.update_lock = asyncio.Lock()
+
+    def createSession(self):
+        ''' Create an aiohttp session with a pooled connector
+
+        Connection establishment is reported to the transport so that
+        the same statistics are available as for SolisCloud
+
+        This needs to be called from within a running event loop
+        '''
+        connector = aiohttp.TCPConnector(
+            limit=self.transport.pool_size,
+            keepalive_timeout=self.config.get('keepalive_timeout', 30)
+            )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.transport.timeout[0],
+            sock_read=self.transport.timeout[1]
+            )
+
+        async def onConnectionStart(session, ctx, params):
+            ctx.connect_start = time.time()
+
+        async def onConnectionEnd(session, ctx, params):
+            self.transport.recordConnection(time.time() - ctx.connect_start)
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_start.append(onConnectionStart)
+        trace.on_connection_create_end.append(onConnectionEnd)
+
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace])
+
+    async def getSession(self):
+        ''' Return the session, creating it if necessary
+
+        Unlike SolisCloud, a single session is shared by all tasks
+        '''
+        if not self.session:
+            self.session = self.createSession()
+        return self.session
+
+    async def close(self):
+        ''' Release the connection pool
+        '''
+        if self.session:
+            await self.session.close()
+            self.session = False
+
+        if self.refresher:
+            self.refresher.cancel()
+            self.refresher = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def acquireSlot(self, priority, max_wait=None):
+        ''' Queue for a rate limit slot without blocking the event loop,
+        returning the time waited
+        '''
+        max_wait = self.maxWait(max_wait)
+        ticket = self.scheduler.enqueue(priority)
+        try:
+            while not self.scheduler.tryGrant(ticket):
+                self.scheduler.checkWait(ticket, max_wait)
+                await asyncio.sleep(max(0.001, self.scheduler.nextCheck(ticket)))
+        except asyncio.CancelledError:
+            self.scheduler.cancel(ticket)
+            raise
+
+        return time.time() - ticket['enqueued']
+
+    async def postRequest(self, url, headers, data, priority=PRIORITY_BACKGROUND, max_wait=None):
+        ''' Place a request to the API, taking into account
+         internal rate-limit tracking
+
+        Returns a tuple of HTTP status and decoded JSON response
+        (False if the body couldn't be decoded)
+        '''
+        endpoint = endpointName(url)
+        try:
+            wait = await self.acquireSlot(priority, max_wait)
+        except RateLimitExceeded:
+            self.printDebug("Max ratelimit wait exceeded - something's gone wrong, please report it")
+            RATELIMIT_REJECTED.inc(endpoint=endpoint)
+            raise
+
+        RATELIMIT_WAIT.observe(wait, endpoint=endpoint)
+
+        session = await self.getSession()
+        REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+        start = time.time()
+        try:
+            async with session.post(url, headers=headers, data=data) as r:
+                try:
+                    # Soliscloud doesn't always set a JSON content-type
+                    return r.status, await r.json(content_type=None)
+                except ValueError:
+                    return r.status, False
+        finally:
+            self.transport.recordRequest(time.time() - start)
+            REQUEST_LATENCY.observe(time.time() - start, endpoint=endpoint)
+            REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+
+    async def apiCall(self, req_path, req_body_d, priority=None, max_wait=None):
+        ''' Sign and place a request, retrying in line with the retry policy
+        '''
+        endpoint = endpointName(req_path)
+        priority = priority or self.defaultPriority(endpoint)
+        resp = False
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            trial = self.allowRequest(endpoint)
+
+            try:
+                url, headers, req_body = self.buildRequest(req_path, req_body_d)
+                status, resp = await self.postRequest(url, headers, req_body, priority, max_wait)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.printDebug(f'Request to {req_path} failed: {e}')
+                status, resp = 0, False
+            except BaseException:
+                # Including cancellation, which leaves no outcome for a trial
+                if trial:
+                    self.breaker.releaseTrial()
+                raise
+
+            self.printDebug(f'Got response: {resp}')
+            outcome = self.classifyResponse(status, resp)
+            throttled = self.observeThrottling(status, resp, outcome)
+
+            if outcome != "ok":
+                self.countFailure(endpoint, status, resp)
+
+            if outcome in ["ok", "fatal"]:
+                self.breaker.recordSuccess()
+                return resp
+
+            if not throttled:
+                self.breaker.recordFailure()
+            if attempt < self.retry_policy.max_attempts:
+                delay = self.retry_policy.delay(attempt)
+                self.printDebug(f'Attempt {attempt} of {req_path} failed, will retry after {delay:.2f}s')
+                RETRIES.inc(endpoint=endpoint)
+                await asyncio.sleep(delay)
+
+        return resp
+
+    async def readChargeDischargeSchedule(self, sn, priority=PRIORITY_BACKGROUND):
+        ''' Place a request to the API to read the charge schedule settings
+        '''
+        return self.processScheduleResponse(sn, await self.fetchScheduleResponse(sn, priority))
+
+    async def fetchScheduleResponse(self, sn, priority=PRIORITY_BACKGROUND):
+        ''' Place an atRead for the charge schedule and return the
+        response as-is
+        '''
+        return await self.apiCall("/v2/api/atRead", {
+                "inverterSn": sn,
+                "cid" : 103
+            }, priority)
+
+    async def getChargeDischargeSchedule(self, sn, max_age=None, priority=PRIORITY_BACKGROUND):
+        ''' Return the charge schedule settings, using the cached
+        copy where possible
+        '''
+        if max_age is None:
+            max_age = self.config.get('schedule_cache_ttl', 0)
+
+        cached = self.cachedSchedule(sn, max_age)
+        if cached:
+            return cached
+
+        async with self.readLock(sn):
+            cached = self.cachedSchedule(sn, max_age, count_miss=False)
+            if cached:
+                return cached
+
+            return await self.readChargeDischargeSchedule(sn, priority)
+
+    def readLock(self, sn):
+        ''' Return the lock which serialises cache-filling reads of sn
+        '''
+        with self.cache_lock:
+            if sn not in self.read_locks:
+                self.read_locks[sn] = asyncio.Lock()
+            return self.read_locks[sn]
+
+    async def getScheduleSnapshot(self, sn, max_age=None):
+        ''' Return the schedule along with its raw value and the time
+        it was fetched
+        '''
+        timings = await self.getChargeDischargeSchedule(sn, max_age)
+        if not timings:
+            return False
+
+        return self.snapshotFrom(sn, timings)
+
+    async def setChargeDischargeTimings(self, sn, timings, force=False, verify=None):
+        ''' Set charge and discharge rate and timings
+        '''
+        if not self.validateTimingsObj(timings):
+            return False
+
+        value = self.buildScheduleValue(timings)
+
+        if not force:
+            elided = self.checkElision(sn, value)
+            if elided:
+                return elided
+
+        # Journal writes are small and local, so are made synchronously
+        journal_id = self.journalRecord("beginWrite", sn, value)
+        try:
+            resp = await self.apiCall("/v2/api/control", {
+                    "inverterSn": sn,
+                    "cid" : 103,
+                    "value" : value
+                })
+        except BaseException:
+            self.abandonWrite(sn, journal_id)
+            raise
+
+        resp = self.processControlResponse(sn, value, resp, journal_id)
+
+        if verify is None:
+            verify = self.config.get('verify_writes', False)
+
+        if resp and verify:
+            resp.update(await self.verifyWrite(sn, value))
+            if not resp['verified']:
+                return False
+
+        return resp
+
+    async def verifyWrite(self, sn, value, timeout=None):
+        ''' Read the schedule back until it matches value, or timeout
+        seconds pass
+
+        As with the synchronous client, polls have no side effects
+        until verification concludes
+        '''
+        start = time.time()
+        deadline = start + (timeout if timeout is not None else self.config.get('verify_timeout', 30))
+        delay, min_interval = self.verifySchedule()
+        interval = min_interval
+        polls = 0
+        last = False
+
+        while True:
+            await asyncio.sleep(max(0, min(delay, deadline - time.time())))
+            polls += 1
+            try:
+                resp = await self.fetchScheduleResponse(sn, PRIORITY_READ_BEFORE_WRITE)
+            except SolisCloudError as e:
+                self.printDebug(f'VERIFY: poll of {sn} failed: {e}')
+                break
+
+            timings = self.parseScheduleResponse(resp)
+            if timings:
+                last = resp
+                if self.scheduleMatches(timings, value):
+                    return self.recordVerification(sn, True, time.time() - start, polls, last)
+
+            if time.time() >= deadline:
+                break
+
+            delay = interval
+            interval = min(interval * 2, min_interval * 4)
+
+        return self.recordVerification(sn, False, time.time() - start, polls, last)
+
+    async def startScheduleRefresher(self, interval=None):
+        ''' Start a background task to keep the schedule cache warm
+        '''
+        if interval is None:
+            interval = self.config.get('schedule_refresh_interval', 0)
+
+        if not interval or self.refresher:
+            return False
+
+        async def refresh():
+            while True:
+                with self.cache_lock:
+                    serials = set(self.schedule_cache.keys())
+
+                if "inverter" in self.config:
+                    serials.add(self.config['inverter'])
+
+                for sn in serials:
+                    try:
+                        if await self.readChargeDischargeSchedule(sn):
+                            with self.cache_lock:
+                                self.cache_stats['refreshes'] += 1
+                    except Exception as e:
+                        self.printDebug(f'SCHEDULE_CACHE: refresh of {sn} failed: {e}')
+
+                await asyncio.sleep(interval)
+
+        self.refresher = asyncio.ensure_future(refresh())
+        return True
+
+    async def getInverterDetail(self, sn=False, inverter_id=False):
+        ''' Fetch current telemetry for an inverter
+        '''
+        body = {}
+        if sn:
+            body['sn'] = sn
+        if inverter_id:
+            body['id'] = inverter_id
+        if not body:
+            body['sn'] = self.config['inverter']
+
+        resp = await self.apiCall("/v1/api/inverterDetail", body)
+        if not resp or "code" not in resp or resp["code"] != "0":
+            self.printDebug(f'Failed to fetch detail for {body}: {resp}')
+            return False
+
+        return resp['data']
+
+    async def iterInverterList(self, page_size=100, station_id=False):
+        ''' Iterate (with async for) over the inverters on the account
+        '''
+        page = 1
+        while True:
+            body = {"pageNo" : page, "pageSize" : page_size}
+            if station_id:
+                body['stationId'] = station_id
+
+            resp = await self.apiCall("/v1/api/inverterList", body)
+            if not resp or "code" not in resp or resp["code"] != "0":
+                raise SolisCloudError(f'Failed to fetch page {page} of the inverter list: {resp}')
+
+            data = resp['data']['page']
+            for record in data['records']:
+                yield record
+
+            if not data['records'] or page >= int(data.get('pages', 1)):
+                return
+            page += 1
+
+    async def iterInverterDetails(self, serials=False):
+        ''' Fetch the detail of each inverter in turn
+        '''
+        for sn in serials or self.config['inverters']:
+            detail = await self.getInverterDetail(sn)
+            if detail:
+                yield detail
+
+    async def getInverterMonth(self, sn, month, time_zone=0):
+        ''' Fetch per-day energy history for a month (YYYY-MM)
+        '''
+        return await self.getInverterHistory("/v1/api/inverterMonth", {
+                "sn" : sn,
+                "month" : month,
+                "timeZone" : time_zone
+            })
+
+    async def getInverterYear(self, sn, year, time_zone=0):
+        ''' Fetch per-month energy history for a year (YYYY)
+        '''
+        return await self.getInverterHistory("/v1/api/inverterYear", {
+                "sn" : sn,
+                "year" : str(year),
+                "timeZone" : time_zone
+            })
+
+    async def getInverterHistory(self, req_path, body):
+        resp = await self.apiCall(req_path, body)
+        if not resp or "code" not in resp or resp["code"] != "0":
+            self.printDebug(f'Failed to fetch {req_path} for {body}: {resp}')
+            return False
+
+        return resp['data'] or []
+
+    async def updateSchedule(self, mutate):
+        ''' Read the schedule, pass it through mutate and write it back
+
+        Failed requests are retried by apiCall, in line with the retry policy
+        '''
+        async with self.update_lock:
+            return await self._updateSchedule(mutate)
+
+    async def _updateSchedule(self, mutate):
+        sn = self.config['inverter']
+
+        timings = await self.getChargeDischargeSchedule(sn, priority=PRIORITY_READ_BEFORE_WRITE)
+        if not timings:
+            self.printDebug('Failed to fetch timings object')
+            return False
+
+        mutate(timings)
+
+        if not await self.setChargeDischargeTimings(sn, timings):
+            self.printDebug('Failed to set timings')
+            return False
+
+        return True
+
+    async def immediateStart(self, action="charge", hours=3, exact=False, rates=False):
+        ''' Immediately start an action
+        '''
+        timerange = self.calculateDynamicTimeRange(hours, exact)
+        self.printDebug(f'Generating a {action} timings payload for {timerange}')
+
+        def mutate(timings):
+            self.setSlotAction(timings, action, timerange)
+            self.applyRates(timings, rates)
+
+        return await self.updateSchedule(mutate)
+
+    async def immediateStop(self, rates=False):
+        ''' Immediately stop charging and discharging
+        '''
+        def mutate(timings):
+            self.setSlotAction(timings, "stop")
+            self.applyRates(timings, rates)
+
+        return await self.updateSchedule(mutate)
+
+    async def setCurrents(self, rates):
+        ''' Set the charge and discharge rates
+        '''
+        return await self.updateSchedule(lambda timings: self.applyRates(timings, rates))
+
+    async def applyWindows(self, windows, rates=False, overflow="defer"):
+        ''' Replace the schedule with a set of charge/discharge windows
+        in a single write
+        '''
+        packer = SlotPacker().addWindows(windows)
+        deferred = []
+
+        def mutate(timings):
+            slots, d = packer.pack(overflow=overflow)
+            timings['slots'] = slots
+            deferred[:] = d
+            self.applyRates(timings, rates)
+
+        return await self.updateSchedule(mutate), deferred
+
+    async def startCharge(self, hours=3, exact=False, rates=False):
+        ''' Start a charge immediately
+        '''
+        return await self.immediateStart("charge", hours, exact, rates)
+
+    async def stopCharge(self, rates=False):
+        ''' Stop a charge immediately
+        '''
+        return await self.immediateStop(rates)
+
+    async def startDischarge(self, hours=3, exact=False, rates=False):
+        ''' Start a discharge immediately
+        '''
+        return await self.immediateStart("discharge", hours, exact, rates)
+
+    async def stopDischarge(self, rates=False):
+        ''' Stop a discharge immediately
+        '''
+        return await self.immediateStop(rates)
+
+
+if __name__ == "__main__":
+    # Are we running in debug mode?
+    DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+
+    config = configFromEnv()
+
+    async def main():
+        async with AsyncSolisCloud(config, debug=DEBUG) as soliscloud:
+            print(await soliscloud.readChargeDischargeSchedule(config['inverter']))
+
+    asyncio.run(main())
@@ -40,73 +40,967 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import datetime
 import base64
+import contextlib
+import copy
 import hashlib
 import hmac
 import json
+import math
 import os
+import random
 import re
 import requests
-import sys
+import threading
 import time
 
+from collections import deque
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from journal import ScheduleJournal
+from metrics import Counter, Gauge, Histogram
+from slots import SlotPacker
+
+
+# Instrumentation
+#
+# These are registered with the default metrics registry, so are
+# exposed by the control server's /metrics endpoint
+REQUEST_LATENCY = Histogram("soliscloud_request_duration_seconds",
+    "Time taken for requests to the Soliscloud API", ["endpoint"])
+REQUESTS_IN_FLIGHT = Gauge("soliscloud_requests_in_flight",
+    "Requests to the Soliscloud API currently in progress", ["endpoint"])
+RATELIMIT_WAIT = Histogram("soliscloud_ratelimit_wait_seconds",
+    "Time spent waiting for a rate limit slot", ["endpoint"],
+    buckets=(0, 0.1, 0.25, 0.5, 1, 2, 3, 4, 5, 8, 10, 20))
+RATELIMIT_REJECTED = Counter("soliscloud_ratelimit_rejected_total",
+    "Requests abandoned because the rate limit wait would exceed max_ratelimit_wait", ["endpoint"])
+RATELIMIT_BREACHES = Counter("soliscloud_ratelimit_check_breaches_total",
+    "Calls to checkRateLimit which found no free slot")
+RETRIES = Counter("soliscloud_retries_total",
+    "Requests to the Soliscloud API which were retried", ["endpoint"])
+RESPONSE_ERRORS = Counter("soliscloud_response_errors_total",
+    "Failed requests to the Soliscloud API by response code", ["endpoint", "code"])
+SCHEDULER_WAIT = Histogram("soliscloud_scheduler_wait_seconds",
+    "Time requests spent queued for a rate limit slot, by priority class", ["priority"],
+    buckets=(0, 0.1, 0.25, 0.5, 1, 2, 3, 4, 5, 8, 10, 20, 30, 60))
+SCHEDULER_QUEUED = Gauge("soliscloud_scheduler_queued",
+    "Requests currently queued for a rate limit slot, by priority class", ["priority"])
+WRITE_APPLY_TIME = Histogram("soliscloud_write_apply_seconds",
+    "Time from a control write being accepted to the new schedule being read back",
+    buckets=(0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60, 120))
+WRITE_VERIFY = Counter("soliscloud_write_verify_total",
+    "Outcome of post-write verification", ["result"])
+THROTTLED = Counter("soliscloud_throttled_total",
+    "Responses indicating that Soliscloud is throttling us")
+RATELIMIT_RATE = Gauge("soliscloud_ratelimit_rate",
+    "Requests per second currently allowed by the rate limiter")
+CIRCUIT_REJECTED = Counter("soliscloud_circuit_rejected_total",
+    "Requests refused because the circuit breaker was open", ["endpoint"])
+
+
+# Format of a slot's time range, HH:MM-HH:MM
+TIMERANGE_RE = re.compile("[0-2][0-9]:[0-5][0-9]-[0-2][0-9]:[0-5][0-9]")
+
+
+# Request priority classes, most important first
+PRIORITY_CONTROL = "control"
+PRIORITY_READ_BEFORE_WRITE = "read_before_write"
+PRIORITY_BACKGROUND = "background"
+PRIORITIES = [PRIORITY_CONTROL, PRIORITY_READ_BEFORE_WRITE, PRIORITY_BACKGROUND]
+
+
+def endpointName(url):
+    ''' Turn a URL or request path into a short name for use in metrics
+    '''
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+class SolisCloudError(Exception):
+    ''' Base class for errors raised by this library
+    '''
+    pass
+
+
+class RateLimitExceeded(SolisCloudError):
+    ''' Raised when a request cannot be placed within the
+    configured maximum rate-limit wait
+
+    retry_after gives the number of seconds until a slot
+    is expected to become available
+    '''
+    def __init__(self, msg, retry_after=0):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(SolisCloudError):
+    ''' Raised when requests are being refused because the
+    API has recently been failing
+
+    retry_after gives the number of seconds until a request
+    will next be attempted
+    '''
+    def __init__(self, msg, retry_after=0):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    ''' Sliding window rate limiter
+
+    Allows at most `limit` requests in any `window` second period.
+
+    Callers reserve a slot and are told exactly how long they need
+    to wait before using it, so a burst is spread out across the
+    window rather than being retried in whole-second steps.
+
+    A single instance can be shared between SolisCloud objects (and
+    threads) so that they observe a common budget
+    '''
+
+    def __init__(self, limit=3, window=5):
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+
+        # Times at which slots have been granted. These may be
+        # in the future if a caller has been asked to wait
+        self.granted = deque()
+
+        # Total number of slots granted
+        self.total = 0
+
+    def _prune(self, now):
+        ''' Drop grants which have fallen out of the window
+        '''
+        while self.granted and self.granted[0] <= now - self.window:
+            self.granted.popleft()
+
+    def _nextSlot(self, now):
+        ''' Calculate the time at which the next slot will be available
+        '''
+        if len(self.granted) < self.limit:
+            return now
+
+        # The next slot frees up when the grant `limit` places
+        # back from the end leaves the window
+        return max(now, self.granted[-self.limit] + self.window)
+
+    def maxThroughput(self):
+        ''' The maximum sustained number of requests per second
+        '''
+        return self.limit / self.window
+
+    def idealElapsed(self, requests):
+        ''' The quickest that `requests` requests could be placed
+        without breaching the limit: the first `limit` go immediately,
+        then a batch per window
+        '''
+        return max(0, math.ceil(requests / self.limit) - 1) * self.window
+
+    def sustainedRate(self, requests, elapsed):
+        ''' The request rate achieved over elapsed seconds, excluding
+        the initial burst of `limit` which the window allows straight
+        away, so that it's comparable with maxThroughput()
+        '''
+        if not elapsed:
+            return 0
+        return max(0, requests - self.limit) / elapsed
+
+    def estimateWait(self, ahead=0):
+        ''' Estimate how long a request would wait for a slot if
+        `ahead` requests are to be served before it
+        '''
+        with self.lock:
+            now = time.time()
+            self._prune(now)
+
+            # When each of the next `limit` slots frees up. After
+            # that, slots repeat a window later
+            free = [now] * (self.limit - len(self.granted)) + [g + self.window for g in self.granted]
+            free.sort()
+            cycles, idx = divmod(ahead, self.limit)
+            return max(0, free[idx] + cycles * self.window - now)
+
+    def timeUntilNextSlot(self):
+        ''' Return the number of seconds until a request could be placed
+        without breaching the limit
+        '''
+        with self.lock:
+            now = time.time()
+            self._prune(now)
+            return self._nextSlot(now) - now
+
+    def reserve(self, max_wait=None):
+        ''' Reserve the next available slot and return the number of
+        seconds the caller must wait before using it
+
+        If the wait would exceed max_wait, no slot is reserved and
+        RateLimitExceeded is raised instead
+        '''
+        with self.lock:
+            now = time.time()
+            self._prune(now)
+            slot = self._nextSlot(now)
+            wait = slot - now
+
+            if max_wait is not None and wait > max_wait:
+                raise RateLimitExceeded(f"Rate limit wait of {wait:.2f}s would exceed {max_wait}s", wait)
+
+            self.granted.append(slot)
+            self.total += 1
+            return wait
+
+    def tryAcquire(self):
+        ''' Take a slot if one is available right now
+
+        Returns a boolean indicating whether a slot was taken
+        '''
+        try:
+            self.reserve(max_wait=0)
+        except RateLimitExceeded:
+            return False
+        return True
+
+    def recordSuccess(self):
+        ''' Called after each successful request. The static limiter
+        doesn't adapt, see AdaptiveRateLimiter
+        '''
+        pass
+
+    def recordThrottle(self):
+        ''' Called when a response indicates that we've been throttled
+        '''
+        pass
+
+    def getStats(self):
+        ''' Return the current limit
+        '''
+        return {
+            "adaptive" : False,
+            "limit" : self.limit,
+            "window" : self.window,
+            "rate" : self.maxThroughput(),
+            "total" : self.total
+            }
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    ''' A rate limiter which learns how fast the API will let us go
+
+    Soliscloud's docs give a limit, but not how throttling is signalled
+    or whether the limit is actually enforced as written. This applies
+    AIMD (as TCP does): after `limit` consecutive successful requests
+    the allowed rate grows by `increase` requests per second, at most
+    once per window, and each time we're throttled it's multiplied by
+    `decrease`. The rate is kept between min_rate and max_rate.
+
+    The rate we were last throttled at is remembered as a ceiling, and
+    growth stops one step below it rather than running into it again.
+    Only after PROBE_WINDOWS windows without a change do we step above
+    it, in case the limit has since been raised; if that's throttled we
+    return to the rate which was working rather than backing off.
+
+    The burst size (`limit`) stays fixed, it's the window which is
+    stretched or shrunk to achieve the rate.
+
+    If state_path is provided, the learned rate is saved there and
+    restored at startup, so that a restart doesn't have to re-learn it
+    '''
+
+    PROBE_WINDOWS = 20
+
+    def __init__(self, limit=3, window=5, min_rate=0.1, max_rate=None, increase=0.05, decrease=0.5, state_path=None):
+        super().__init__(limit, window)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or (2 * limit / window)
+        self.increase = increase
+        self.decrease = decrease
+        self.state_path = state_path
+
+        self.rate = limit / window
+        self.ceiling = None
+        self.probe_from = None
+        self.successes = 0
+        self.last_change = 0
+        self.last_decrease = 0
+        self.stats = {"throttles" : 0, "ignored_throttles" : 0, "increases" : 0, "decreases" : 0, "probes" : 0, "restored" : False}
+
+        self.loadState()
+        self.setRate(self.rate)
+
+    def setRate(self, rate):
+        ''' Apply a new rate, within the configured bounds
+
+        Must be called with the lock held (or before the limiter is in use)
+        '''
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.window = self.limit / self.rate
+        RATELIMIT_RATE.set(self.rate)
+
+    def recordSuccess(self):
+        with self.lock:
+            self.successes += 1
+            if self.successes < self.limit or self.rate >= self.max_rate:
+                return
+
+            # A change can't be judged until a window's worth of requests
+            # has been sent at the new rate
+            now = time.time()
+            since = now - self.last_change
+            if since < self.window:
+                return
+
+            rate = self.rate + self.increase
+            if self.ceiling is not None and rate > self.ceiling - self.increase:
+                if since < self.PROBE_WINDOWS * self.window:
+                    rate = self.ceiling - self.increase
+                    if rate <= self.rate:
+                        # Any probe has survived a window, so it's the new normal
+                        self.probe_from = None
+                        return
+                else:
+                    self.probe_from = self.rate
+                    self.ceiling = rate + self.increase
+                    self.stats['probes'] += 1
+
+            self.successes = 0
+            self.last_change = now
+            self.setRate(rate)
+            self.stats['increases'] += 1
+            rate, ceiling = self.rate, self.ceiling
+
+        self.saveState(rate, ceiling)
+
+    def recordThrottle(self):
+        with self.lock:
+            self.stats['throttles'] += 1
+            self.successes = 0
+
+            # Requests placed before the last decrease will have been sent
+            # at the old rate, so throttling of those says nothing new
+            now = time.time()
+            if now - self.last_decrease < self.window:
+                self.stats['ignored_throttles'] += 1
+                return
+
+            self.last_decrease = self.last_change = now
+            self.ceiling = self.rate
+            if self.probe_from is not None:
+                # A failed probe only shows that the limit hasn't moved,
+                # so go straight back to the rate which was working
+                self.setRate(self.probe_from)
+                self.probe_from = None
+            else:
+                self.setRate(self.rate * self.decrease)
+            self.stats['decreases'] += 1
+            rate, ceiling = self.rate, self.ceiling
+
+        self.saveState(rate, ceiling)
+
+    def loadState(self):
+        ''' Restore a previously learned rate and ceiling
+        '''
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+
+        try:
+            with open(self.state_path) as fh:
+                state = json.load(fh)
+            self.rate = float(state['rate'])
+            if state.get('ceiling') is not None:
+                self.ceiling = float(state['ceiling'])
+            self.stats['restored'] = True
+        except (OSError, ValueError, KeyError, TypeError):
+            # Start from the configured rate instead
+            pass
+
+    def saveState(self, rate, ceiling=None):
+        ''' Write the learned rate to state_path, atomically so that a
+        crash can't leave a truncated file behind
+        '''
+        if not self.state_path:
+            return
+
+        tmp = f"{self.state_path}.tmp"
+        try:
+            with open(tmp, "w") as fh:
+                json.dump({"rate" : rate, "ceiling" : ceiling, "updated" : time.time()}, fh)
+            os.replace(tmp, self.state_path)
+        except OSError:
+            # Losing the learned rate isn't worth failing a request over
+            pass
+
+    def getStats(self):
+        ''' Return the current rate along with adjustment counts
+        '''
+        with self.lock:
+            res = dict(self.stats)
+            res.update({
+                "adaptive" : True,
+                "limit" : self.limit,
+                "window" : self.window,
+                "rate" : self.rate,
+                "ceiling" : self.ceiling,
+                "min_rate" : self.min_rate,
+                "max_rate" : self.max_rate,
+                "total" : self.total
+                })
+            return res
+
+
+def rateLimiterFromConfig(config):
+    ''' Create the rate limiter described by config
+    '''
+    if config.get('adaptive_rate_limit', False):
+        return AdaptiveRateLimiter(
+            config['api_rate_limit'],
+            config.get('api_rate_limit_window', 5),
+            config.get('rate_limit_min', 0.1),
+            config.get('rate_limit_max', None),
+            config.get('rate_limit_increase', 0.05),
+            config.get('rate_limit_decrease', 0.5),
+            config.get('rate_limit_state_file', None)
+            )
+
+    return RateLimiter(
+        config['api_rate_limit'],
+        config.get('api_rate_limit_window', 5)
+        )
+
+
+class RequestScheduler:
+    ''' Hands out rate limit slots in priority order
+
+    Requests queue here rather than reserving slots in the future, so
+    that when a slot frees up it goes to the most important waiting
+    request (see PRIORITIES) - a control write doesn't have to wait
+    behind a backlog of background reads.
+
+    To prevent starvation, a request's effective priority improves by
+    one class for every `aging` seconds that it has been waiting.
+    Within a class, requests are served in the order they arrived.
+
+    Like the RateLimiter, a single instance can be shared between
+    SolisCloud objects
+    '''
+
+    def __init__(self, ratelimiter, aging=10):
+        self.ratelimiter = ratelimiter
+        self.aging = aging
+        self.cond = threading.Condition()
+        self.queue = []
+        self.seq = 0
+        self.stats = {p : {"queued" : 0, "granted" : 0, "rejected" : 0, "wait_total" : 0, "wait_max" : 0}
+                      for p in PRIORITIES}
+
+    def _score(self, ticket, now):
+        ''' Effective priority of a queued request: lower is served first
+        '''
+        waited = now - ticket['enqueued']
+        aged = (waited / self.aging) if self.aging else 0
+        return (PRIORITIES.index(ticket['priority']) - aged, ticket['seq'])
+
+    def _ahead(self, ticket, now):
+        ''' Count the requests which would currently be served before ticket
+        '''
+        mine = self._score(ticket, now)
+        return len([t for t in self.queue if t is not ticket and self._score(t, now) < mine])
+
+    def enqueue(self, priority):
+        ''' Join the queue, returning a ticket for tryGrant
+        '''
+        if priority not in PRIORITIES:
+            raise ValueError(f'Unknown priority {priority}, should be one of {PRIORITIES}')
+
+        with self.cond:
+            self.seq += 1
+            ticket = {"priority" : priority, "enqueued" : time.time(), "seq" : self.seq}
+            self.queue.append(ticket)
+            self.stats[priority]['queued'] += 1
+        SCHEDULER_QUEUED.inc(priority=priority)
+        return ticket
+
+    def tryGrant(self, ticket):
+        ''' Take a slot for ticket, if it's at the head of the queue and
+        one is free. Returns a boolean indicating whether it was granted
+        '''
+        with self.cond:
+            now = time.time()
+            if self._ahead(ticket, now) or not self.ratelimiter.tryAcquire():
+                return False
+
+            self._leave(ticket, now, "granted")
+            return True
+
+    def cancel(self, ticket):
+        ''' Leave the queue without being granted a slot
+        '''
+        with self.cond:
+            if ticket in self.queue:
+                self._leave(ticket, time.time(), "rejected")
+
+    def _leave(self, ticket, now, outcome):
+        ''' Remove ticket from the queue and record the outcome
+
+        Must be called with the lock held
+        '''
+        self.queue.remove(ticket)
+        waited = now - ticket['enqueued']
+        stats = self.stats[ticket['priority']]
+        stats[outcome] += 1
+        if outcome == "granted":
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+            SCHEDULER_WAIT.observe(waited, priority=ticket['priority'])
+        SCHEDULER_QUEUED.dec(priority=ticket['priority'])
+
+        # Someone else may now be at the head of the queue
+        self.cond.notify_all()
+
+    def nextCheck(self, ticket):
+        ''' Return how long the holder of ticket should wait before
+        trying again
+        '''
+        with self.cond:
+            if self._ahead(ticket, time.time()):
+                # Aging may promote us without anyone else waking,
+                # so check in at least once a second
+                return min(1, self.aging or 1)
+            return self.ratelimiter.timeUntilNextSlot()
+
+    def checkWait(self, ticket, max_wait):
+        ''' Raise RateLimitExceeded (leaving the queue) if ticket can't
+        expect to be served within max_wait seconds of joining it
+        '''
+        if max_wait is None:
+            return
+
+        with self.cond:
+            now = time.time()
+            remaining = ticket['enqueued'] + max_wait - now
+            estimate = self.ratelimiter.estimateWait(self._ahead(ticket, now))
+            if estimate <= remaining:
+                return
+
+            self._leave(ticket, now, "rejected")
+
+        raise RateLimitExceeded(f"Rate limit wait of {estimate:.2f}s would exceed {max_wait}s", estimate)
+
+    def acquire(self, priority, max_wait=None):
+        ''' Block until a slot is granted, returning the time waited
+
+        If the wait would exceed max_wait, RateLimitExceeded is raised
+        '''
+        ticket = self.enqueue(priority)
+        with self.cond:
+            while not self.tryGrant(ticket):
+                self.checkWait(ticket, max_wait)
+                self.cond.wait(max(0.001, self.nextCheck(ticket)))
+
+        return time.time() - ticket['enqueued']
+
+    def waiting(self):
+        ''' Return the number of requests currently queued for a slot
+        '''
+        with self.cond:
+            return len(self.queue)
+
+    def getStats(self):
+        ''' Return per-class queue statistics
+        '''
+        with self.cond:
+            stats = {}
+            for p, s in self.stats.items():
+                stats[p] = dict(s)
+                stats[p]['waiting'] = len([t for t in self.queue if t['priority'] == p])
+                stats[p]['wait_avg'] = (s['wait_total'] / s['granted']) if s['granted'] else 0
+            return stats
+
+
+class RetryPolicy:
+    ''' Decides whether, and when, a failed request should be retried
+
+    Delays grow exponentially from base_delay (capped at max_delay) and
+    have up to `jitter` (a fraction) of the delay randomly removed so that
+    clients which failed together don't retry together.
+
+    Transport errors, HTTP 429 and 5xx responses and unparseable bodies are
+    always considered retryable. Responses with a non-zero code are
+    retryable unless the code is listed in fatal_codes
+    '''
+
+    def __init__(self, max_attempts=3, base_delay=1, max_delay=30, jitter=0.5, fatal_codes=()):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.fatal_codes = set(fatal_codes)
+
+    def delay(self, attempt):
+        ''' How long to wait after the given (1-indexed) attempt failed
+        '''
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay - random.uniform(0, delay * self.jitter)
+
+    def isFatal(self, code):
+        ''' Is a non-zero response code one that won't be fixed by retrying
+        '''
+        return code in self.fatal_codes
+
+
+class CircuitBreaker:
+    ''' Fails fast whilst the API is unhealthy
+
+    After `threshold` consecutive failures the circuit opens and requests
+    are refused (with CircuitOpen) for reset_timeout seconds. After that a
+    single trial request is let through - if it succeeds the circuit closes,
+    otherwise it re-opens.
+
+    A threshold of 0 disables the breaker
+    '''
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = False
+        self.trial_in_flight = False
+
+    def state(self):
+        ''' Return one of closed, open or half-open
+        '''
+        with self.lock:
+            if not self.opened:
+                return "closed"
+            if time.time() - self.opened >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def refusing(self):
+        ''' Check whether requests are currently being refused: the circuit
+        is open, or half-open with the trial still in flight
+        '''
+        with self.lock:
+            if not self.opened:
+                return False
+            return self.trial_in_flight or time.time() - self.opened < self.reset_timeout
+
+    def allow(self):
+        ''' Check whether a request may be placed, raising CircuitOpen if not
+
+        Returns True if the request is the half-open trial, in which case
+        the caller must report its outcome with recordSuccess/recordFailure
+        or give it up with releaseTrial
+        '''
+        if not self.threshold:
+            return False
+
+        with self.lock:
+            if not self.opened:
+                return False
+
+            remaining = self.opened + self.reset_timeout - time.time()
+            if remaining <= 0 and not self.trial_in_flight:
+                # Let a single request through to test the water
+                self.trial_in_flight = True
+                return True
+
+            raise CircuitOpen("Circuit open: Soliscloud API has been failing", max(remaining, 1))
+
+    def releaseTrial(self):
+        ''' Give up the trial without an outcome (for example, because it
+        was never sent), so that the next request can be the trial instead
+        '''
+        with self.lock:
+            self.trial_in_flight = False
+
+    def recordSuccess(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = False
+            self.trial_in_flight = False
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_flight or (self.threshold and self.failures >= self.threshold):
+                self.opened = time.time()
+            self.trial_in_flight = False
+
+
+class Transport:
+    ''' HTTP transport for talking to the API
+
+    Creates sessions with a sized, keep-alive connection pool, applies
+    connect and read timeouts and records how many connections were
+    opened (vs. reused), how long was spent establishing them (TCP and
+    TLS handshakes) and how long was spent waiting for responses.
+
+    Retries are left to SolisCloud.apiCall, so the adapter doesn't retry
+    '''
+
+    def __init__(self, connect_timeout=5, read_timeout=30, pool_size=10):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests" : 0,
+            "connections_opened" : 0,
+            "connect_time" : 0.0,
+            "request_time" : 0.0
+            }
+
+    def recordConnection(self, duration):
+        with self.lock:
+            self.stats['connections_opened'] += 1
+            self.stats['connect_time'] += duration
+
+    def recordRequest(self, duration):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['request_time'] += duration
+
+    def createSession(self):
+        ''' Create a requests session using an instrumented adapter
+        '''
+        session = requests.session()
+        adapter = InstrumentedAdapter(self, pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def post(self, session, url, headers, data):
+        ''' Place a POST using session
+        '''
+        start = time.time()
+        try:
+            return session.post(url=url, headers=headers, data=data, timeout=self.timeout)
+        finally:
+            self.recordRequest(time.time() - start)
+
+    def getStats(self):
+        ''' Return connection and timing statistics
+        
+        response_wait is time spent in requests less time spent
+        establishing connections
+        '''
+        with self.lock:
+            stats = dict(self.stats)
+        
+        stats['connections_reused'] = max(0, stats['requests'] - stats['connections_opened'])
+        stats['response_wait'] = max(0, stats['request_time'] - stats['connect_time'])
+        return stats
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    ''' A requests adapter whose connection pools report newly
+    established connections (and how long they took) to a Transport
+    '''
+
+    def __init__(self, transport, **kwargs):
+        self.transport = transport
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        
+        transport = self.transport
+        
+        def timedConnect(cls):
+            ''' Wrap a connection class so that connect() is timed
+            '''
+            def connect(conn):
+                start = time.time()
+                cls.connect(conn)
+                transport.recordConnection(time.time() - start)
+            return type(f"Instrumented{cls.__name__}", (cls,), {"connect" : connect})
+        
+        self.poolmanager.pool_classes_by_scheme = {
+            "http" : type("InstrumentedHTTPConnectionPool", (HTTPConnectionPool,), {"ConnectionCls" : timedConnect(HTTPConnection)}),
+            "https" : type("InstrumentedHTTPSConnectionPool", (HTTPSConnectionPool,), {"ConnectionCls" : timedConnect(HTTPSConnection)})
+            }
+
 
 class SolisCloud:
 
-    def __init__(self, config, session=False, debug=False):
+    def __init__(self, config, session=False, debug=False, ratelimiter=False, sessions=False, transport=False,
+                 journal=False, scheduler=False):
         self.config = config
         self.debug = debug
-        if session:
-            self.session = session
+        
+        if transport:
+            self.transport = transport
         else:
-            self.session = requests.session()
+            self.transport = Transport(
+                config.get('connect_timeout', 5),
+                config.get('read_timeout', 30),
+                config.get('pool_size', 10)
+                )
+        
+        # If the caller provides a session, it'll be used for all requests.
+        # Otherwise each thread gets its own (see getSession). The thread-local
+        # store can be shared between instances by passing sessions
+        self.session = session
+        if sessions:
+            self.sessions = sessions
+        else:
+            self.sessions = threading.local()
+
+        # Per-thread overrides of how long requests may wait for a
+        # rate limit slot (see rateLimitWait)
+        self.wait_overrides = threading.local()
 
         # Tracking information for rate limit observance
-        self.ratelimit = {
-            "requests" : 0,
-            "lastreset" : time.time()
+        if ratelimiter:
+            self.ratelimiter = ratelimiter
+        else:
+            self.ratelimiter = rateLimiterFromConfig(config)
+
+        # Decides which queued request gets the next slot. If sharing
+        # a rate limiter, share the scheduler too
+        if scheduler:
+            self.scheduler = scheduler
+        else:
+            self.scheduler = RequestScheduler(self.ratelimiter, config.get('scheduler_aging', 10))
+
+        # How to handle failures
+        self.retry_policy = RetryPolicy(
+            config.get('retry_max_attempts', 2) if config.get('do_retry', True) else 1,
+            config.get('retry_delay_s', 1),
+            config.get('retry_max_delay', 30),
+            config.get('retry_jitter', 0.5),
+            config.get('retry_fatal_codes', [])
+            )
+        self.breaker = CircuitBreaker(
+            config.get('circuit_threshold', 5),
+            config.get('circuit_reset_s', 60)
+            )
+
+        # Cached copies of the cid 103 schedule, keyed by inverter serial
+        #
+        # Each entry is a dict with keys timings, value and fetched
+        self.schedule_cache = {}
+        self.cache_lock = threading.Lock()
+        
+        # Per-inverter locks so that only one caller at a time reads
+        # a missing schedule, the others wait for its result
+        self.read_locks = {}
+        
+        # The last schedule value seen for each inverter (unlike the
+        # cache, this survives invalidation) and callables to be
+        # told when it changes
+        self.observed = {}
+        self.schedule_listeners = []
+        self.cache_stats = {
+            "hits" : 0,
+            "misses" : 0,
+            "refreshes" : 0
             }
+        self.refresher = False
+
+        # Serialises read-modify-write cycles so that concurrent
+        # callers don't overwrite each other's changes
+        self.update_lock = threading.RLock()
+
+        # Counts of control writes placed and those skipped
+        # because they wouldn't have changed anything
+        self.write_stats = {
+            "writes" : 0,
+            "elided" : 0,
+            "verified" : 0,
+            "unverified" : 0
+            }
+
+        # Moving average of how long written schedules take to be
+        # visible to atRead, used to time the first verification poll
+        self.apply_estimate = False
+
+        # Optional on-disk record of schedule reads and writes, used
+        # to warm the cache after a restart. Like the rate limiter, it
+        # can be shared between instances
+        if journal:
+            self.journal = journal
+        elif config.get('journal_path', False):
+            self.journal = ScheduleJournal(config['journal_path'], config.get('journal_keep', 100), debug=debug)
+        else:
+            self.journal = False
+
+        self.journal_stats = {
+            "warmed" : 0,
+            "uncertain" : []
+            }
+        if self.journal:
+            self.warmFromJournal()
+
+    def createSession(self):
+        ''' Create a session to talk to the API
+        '''
+        return self.transport.createSession()
+
+    def getSession(self):
+        ''' Return the session to use for the current thread
+        
+        requests doesn't guarantee that a Session is safe to use from
+        multiple threads, so unless one was passed in, each thread
+        gets its own
+        '''
+        if self.session:
+            return self.session
+        
+        session = getattr(self.sessions, "session", False)
+        if not session:
+            session = self.createSession()
+            self.sessions.session = session
+        return session
+
+    @contextlib.contextmanager
+    def rateLimitWait(self, max_wait):
+        ''' Let requests placed by the current thread, within the block,
+        wait up to max_wait seconds for a rate limit slot rather than
+        max_ratelimit_wait
+
+        This is for callers (like SolisFleet) which knowingly queue a lot
+        of requests for the rate limit. Other threads are unaffected
+        '''
+        previous = getattr(self.wait_overrides, "max_wait", None)
+        self.wait_overrides.max_wait = max_wait
+        try:
+            yield
+        finally:
+            self.wait_overrides.max_wait = previous
+
+    def maxWait(self, max_wait=None):
+        ''' Return how long a request may wait for a rate limit slot:
+        max_wait if given, otherwise any override for the current thread,
+        otherwise max_ratelimit_wait
+        '''
+        if max_wait is None:
+            max_wait = getattr(self.wait_overrides, "max_wait", None)
+        return self.config["max_ratelimit_wait"] if max_wait is None else max_wait
 
     def checkRateLimit(self):
-        ''' Check how many requests we've made and when
-        in order to assess whether we're at risk of hitting
-        service rate limits.
+        ''' Check whether a request can be placed right now without
+        risking a breach of the service's rate limits.
         
         The API doc says:
         
             Note: The calling frequency of all interfaces is limited to three times every five seconds for the same IP
         
         It does not clarify whether we'll get a HTTP 429 or some other status
+
+        If a request is approved, a slot is consumed
         '''
-        
-        # What we want to check is
-        #
-        # Was the last reset more than 5 seconds ago
-        # Have there been >= 3 requests?
-        #
-        now = time.time()
-        # When was the last quota reset?
-        if (now - self.ratelimit['lastreset']) >= 1:
-            self.printDebug(f'RATE_LIMIT_CHECK: Last reset was more than 1 seconds ago')
-            # Should be fine, reset the limit
-            self.ratelimit['lastreset'] = now
-            self.ratelimit['requests'] = 1
+        if self.ratelimiter.tryAcquire():
+            self.printDebug('RATE_LIMIT_CHECK: Request approved')
             return True
-        
-        # If we reached this point, we're within the n second boundary
-        # check how many requests have been placed
-        if (self.ratelimit['requests'] + 1) > self.config['api_rate_limit']:
-            self.printDebug(f'RATE_LIMIT_CHECK: Breach - too many requests')
-            # We'd be breaching the rate limit
-            #
-            # We don't increment the counter because we're
-            # preventing the request from being sent yet
-            return False
-        
-        # So we're within the time bounds but haven't yet hit the maximum number of
-        # requests. Increment the counter and approve the request
-        self.printDebug(f'RATE_LIMIT_CHECK: Request approved')
-        self.ratelimit['requests'] += 1
-        return True
+
+        self.printDebug('RATE_LIMIT_CHECK: Breach - too many requests')
+        RATELIMIT_BREACHES.inc()
+        return False
 
     def createHMAC(self, signstr, secret, algo):
         ''' Create a HMAC of signstr using secret and algo
@@ -181,238 +1075,772 @@ class SolisCloud:
         
         return headers
 
-    def postRequest(self, url, headers, data):
+    def buildRequest(self, req_path, req_body_d):
+        ''' Serialise a request body and sign it
+
+        Returns a tuple of url, headers and body
+        '''
+        req_body = json.dumps(req_body_d)
+
+        # Construct an auth header
+        headers = self.doAuth(self.config['api_id'], self.config['api_secret'], req_path, req_body)
+
+        self.printDebug(f'Built request - Headers {headers}, body: {req_body}, path: {req_path}')
+
+        return f"{self.config['api_url']}{req_path}", headers, req_body
+
+    def classifyResponse(self, status, resp):
+        ''' Classify the outcome of a request as one of ok, retry or fatal
+        '''
+        if status == 429 or status >= 500 or not isinstance(resp, dict) or "code" not in resp:
+            return "retry"
+        
+        if resp["code"] == "0":
+            return "ok"
+        
+        if self.retry_policy.isFatal(resp["code"]):
+            return "fatal"
+        
+        return "retry"
+
+    def isThrottled(self, status, resp):
+        ''' Check whether a response indicates that we've been throttled
+        '''
+        if status == 429:
+            return True
+        
+        return isinstance(resp, dict) and resp.get("code", "0") in self.config.get('throttle_codes', [])
+
+    def observeThrottling(self, status, resp, outcome):
+        ''' Tell the rate limiter how a request fared, so that an
+        adaptive one can adjust
+        
+        Returns a boolean indicating whether we were throttled
+        '''
+        if self.isThrottled(status, resp):
+            THROTTLED.inc()
+            self.printDebug('RATE_LIMIT: Request was throttled')
+            self.ratelimiter.recordThrottle()
+            return True
+        
+        if outcome == "ok":
+            self.ratelimiter.recordSuccess()
+        return False
+
+    def countFailure(self, endpoint, status, resp):
+        ''' Count a failed request by the reason it failed
+        '''
+        if isinstance(resp, dict) and "code" in resp:
+            code = resp["code"]
+        elif status:
+            code = f"http_{status}"
+        else:
+            code = "transport_error"
+        
+        RESPONSE_ERRORS.inc(endpoint=endpoint, code=code)
+
+    def allowRequest(self, endpoint):
+        ''' Check with the circuit breaker whether a request can be placed
+
+        Returns True if the request is the circuit's half-open trial
+        '''
+        try:
+            return self.breaker.allow()
+        except CircuitOpen:
+            CIRCUIT_REJECTED.inc(endpoint=endpoint)
+            raise
+
+    def apiCall(self, req_path, req_body_d, priority=None, max_wait=None):
+        ''' Sign and place a request, retrying in line with the retry policy
+        
+        priority is the scheduling class (see PRIORITIES). By default,
+        control writes are PRIORITY_CONTROL and anything else is
+        PRIORITY_BACKGROUND
+        
+        max_wait is how long each attempt may wait for a rate limit slot
+        (see maxWait)
+        
+        Returns the decoded response (which may contain a non-zero code if
+        the call ultimately failed) or False if no usable response was received
+        '''
+        endpoint = endpointName(req_path)
+        priority = priority or self.defaultPriority(endpoint)
+        resp = False
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            trial = self.allowRequest(endpoint)
+            
+            try:
+                # The request is re-signed each time as the Date header
+                # forms part of the signature
+                url, headers, req_body = self.buildRequest(req_path, req_body_d)
+                r = self.postRequest(url, headers, req_body, priority, max_wait)
+                status = r.status_code
+                try:
+                    resp = r.json()
+                except ValueError:
+                    resp = False
+            except requests.exceptions.RequestException as e:
+                self.printDebug(f'Request to {req_path} failed: {e}')
+                status = 0
+                resp = False
+            except BaseException:
+                # e.g. RateLimitExceeded: we don't know how the API is doing,
+                # but the circuit mustn't be left waiting on this trial
+                if trial:
+                    self.breaker.releaseTrial()
+                raise
+            
+            self.printDebug(f'Got response: {resp}')
+            outcome = self.classifyResponse(status, resp)
+            throttled = self.observeThrottling(status, resp, outcome)
+            
+            if outcome == "ok":
+                self.breaker.recordSuccess()
+                return resp
+            
+            self.countFailure(endpoint, status, resp)
+            
+            if outcome == "fatal":
+                # The API is working, it just didn't like the request
+                self.breaker.recordSuccess()
+                return resp
+            
+            # Being throttled means the API is up, we just need to slow
+            # down, so it shouldn't count towards opening the circuit
+            if not throttled:
+                self.breaker.recordFailure()
+            
+            if attempt < self.retry_policy.max_attempts:
+                delay = self.retry_policy.delay(attempt)
+                self.printDebug(f'Attempt {attempt} of {req_path} failed, will retry after {delay:.2f}s')
+                RETRIES.inc(endpoint=endpoint)
+                time.sleep(delay)
+        
+        return resp
+
+    def defaultPriority(self, endpoint):
+        ''' Scheduling class for requests which don't specify one
+        '''
+        return PRIORITY_CONTROL if endpoint == "control" else PRIORITY_BACKGROUND
+
+
+    def postRequest(self, url, headers, data, priority=PRIORITY_BACKGROUND, max_wait=None):
         ''' Place a request to the API, taking into account
          internal rate-limit tracking
+        
+        max_wait is how long it may wait for a rate limit slot
+        (see maxWait)
         '''
         
-        # Check whether this request would hit the service's published rate-limit
-        x = 0
-        while True:
-            if self.checkRateLimit():
-                # We're below the rate limit, break out
-                # so the request can be placed
-                break
-                
-            # Otherwise, this request would hit the rate limit wait a bit and try again
-            x += 1
-            time.sleep(1)
-            if x > self.config["max_ratelimit_wait"]:
-                self.printDebug("Max ratelimit wait exceeded - something's gone wrong, please report it")
-                sys.exit(1)
-            continue
+        # Queue for a slot within the service's published rate-limit
+        #
+        # If we'd have to wait longer than the configured maximum, something
+        # is badly wrong (or we're being asked to do too much) so raise
+        # rather than blocking indefinitely
+        endpoint = endpointName(url)
+        try:
+            wait = self.scheduler.acquire(priority, self.maxWait(max_wait))
+        except RateLimitExceeded:
+            self.printDebug("Max ratelimit wait exceeded - something's gone wrong, please report it")
+            RATELIMIT_REJECTED.inc(endpoint=endpoint)
+            raise
+
+        RATELIMIT_WAIT.observe(wait, endpoint=endpoint)
+        if wait > 0:
+            self.printDebug(f'RATE_LIMIT_CHECK: Waited {wait:.3f}s for a {priority} slot')
         
         # Place the request
-        return self.session.post(url=url, headers=headers, data=data)
+        REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+        start = time.time()
+        try:
+            return self.transport.post(self.getSession(), url, headers, data)
+        finally:
+            REQUEST_LATENCY.observe(time.time() - start, endpoint=endpoint)
+            REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        
+
+    def printDebug(self, msg):
+        if self.debug:
+            print(msg)
+        
+
+    def calculateDynamicTimeRange(self, end_hours = 3, exact = False):
+        ''' Calculate a time range to pass into the API
+        '''
+        
+        now = datetime.datetime.now()
+        
+        hour_begin = now.replace(minute=0)
+        if not exact:
+            hour_end = hour_begin + datetime.timedelta(hours=end_hours)
+        else:
+            hour_end = hour_begin.replace(hour=exact['hour'], minute=exact['minute'])
+        
+        if int(hour_begin.strftime("%H")) > int(hour_end.strftime("%H")):
+            # Time wrapped
+            hour_end = hour_end.replace(hour=0, minute=0)
+        
+        # Turn into a textual range
+        b = hour_begin.strftime("%H:%M")
+        e = hour_end.strftime("%H:%M")
+        
+        return f"{b}-{e}"
+        
+
+    def setSlotAction(self, timings, action, timerange="00:00-00:00"):
+        ''' Update the dynamic slot in timings to perform action
+        during timerange
+        
+        action should be one of charge, discharge or stop
+        '''
+        slot = f"slot{self.config['dynamic_slot']}"
+        
+        if action == "charge":
+            timings['slots'][slot]['charge'] = timerange
+            timings['slots'][slot]['discharge'] = "00:00-00:00"
+        elif action == "discharge":
+            timings['slots'][slot]['discharge'] = timerange
+            timings['slots'][slot]['charge'] = "00:00-00:00"
+        else:
+            timings['slots'][slot]['charge'] = "00:00-00:00"
+            timings['slots'][slot]['discharge'] = "00:00-00:00"
+        
+        return timings
+
+
+    def applyRates(self, timings, rates):
+        ''' Update the currents in timings if the caller has
+        asked to change them
+        '''
+        if rates:
+            if "charge_current" in rates:
+                timings['charge_current'] = rates['charge_current']
+            if "discharge_current" in rates:
+                timings['discharge_current'] = rates['discharge_current']
+        
+        return timings
+
+
+    def updateSchedule(self, mutate):
+        ''' Read the schedule, pass it through mutate and write it back
+        
+        Failed requests are retried by apiCall, in line with the retry policy
+        '''
+        with self.update_lock:
+            return self._updateSchedule(mutate)
+
+
+    def _updateSchedule(self, mutate):
+        sn = self.config['inverter']
+        
+        # Get existing schedule and settings. The write is waiting
+        # on this, so it jumps ahead of background requests
+        timings = self.getChargeDischargeSchedule(sn, priority=PRIORITY_READ_BEFORE_WRITE)
+        if not timings:
+            self.printDebug(f'Failed to fetch timings object')
+            return False
+        
+        mutate(timings)
+        
+        # Set the schedule
+        if not self.setChargeDischargeTimings(sn, timings):
+            self.printDebug(f'Failed to set timings')
+            return False
+        
+        return True
+
+
+    def immediateStart(self, action="charge", hours=3, exact=False, rates=False):
+        ''' Immediately start an action
+        '''
+               
+        timerange = self.calculateDynamicTimeRange(hours, exact)
+        self.printDebug(f'Generating a {action} timings payload for {timerange}')
+        
+        def mutate(timings):
+            # Set the charge timing for the relevant slot
+            self.setSlotAction(timings, action, timerange)
+            self.applyRates(timings, rates)
+        
+        return self.updateSchedule(mutate)
+
+
+    def immediateStop(self, rates=False):
+        ''' Immediately stop charging and discharging
+        '''
+        def mutate(timings):
+            # Clear the timings for the relevant slot
+            self.setSlotAction(timings, "stop")
+            self.applyRates(timings, rates)
+        
+        return self.updateSchedule(mutate)
+    
+    
+    def readChargeDischargeSchedule(self, sn, priority=PRIORITY_BACKGROUND):
+        ''' Place a request to the API to read the charge schedule settings
+        
+        This always goes to the API, the result is used to refresh the
+        schedule cache (see getChargeDischargeSchedule)
+        '''
+        
+        return self.processScheduleResponse(sn, self.fetchScheduleResponse(sn, priority))
+
+
+    def fetchScheduleResponse(self, sn, priority=PRIORITY_BACKGROUND):
+        ''' Place an atRead for the charge schedule and return the
+        response as-is
+        '''
+        return self.apiCall("/v2/api/atRead", {
+                "inverterSn": sn,
+                "cid" : 103
+            }, priority)
+
+
+    def parseScheduleResponse(self, resp):
+        ''' Turn an atRead response into a timings dict, without
+        any side effects. Returns False if the read failed
+        '''
+        if not resp or "code" not in resp or resp["code"] != "0":
+            return False
+        
+        timings = self.parseScheduleValue(resp['data']['msg'])
+        timings['raw'] = resp
+        return timings
+
+
+    def processScheduleResponse(self, sn, resp):
+        ''' Turn an atRead response into a timings dict
+        and update the cache
+        '''
+        timings = self.parseScheduleResponse(resp)
+        if not timings:
+            return False
+
+        self.cacheSchedule(sn, timings, resp['data']['msg'])
+        self.journalRecord("recordRead", sn, resp['data']['msg'])
+        
+        return timings
+
+
+    def parseScheduleValue(self, value):
+        ''' Turn the value string used by cid 103 into a timings dict
+        
+        The string looks like this
+        20,55,00:00-06:00,00:00-00:00,0,0,12:00-16:00,00:00-00:00,0,0,00:00-00:00,00:00-00:00
+        
+        We need to take the first two values (charge and discharge current, respectively) and
+        then iterate through the timeslots
+        '''
+        timings = {}
+        slots = value.split(',')
+        timings['charge_current'] = slots[0]
+        timings['discharge_current'] = slots[1]
+        
+        timings["slots"] = {
+            "slot1": { "charge": slots[2], "discharge": slots[3]},
+            "slot2": { "charge": slots[6], "discharge": slots[7]},
+            "slot3": { "charge": slots[10], "discharge": slots[11]}
+            }
+        
+        return timings
+
+
+    def getChargeDischargeSchedule(self, sn, max_age=None, priority=PRIORITY_BACKGROUND):
+        ''' Return the charge schedule settings, using the cached copy
+        if it's younger than max_age seconds (defaults to schedule_cache_ttl)
         
+        Falls back to readChargeDischargeSchedule on a cache miss. The
+        returned dict is a copy and so can safely be modified by the caller
+        '''
+        if max_age is None:
+            max_age = self.config.get('schedule_cache_ttl', 0)
+        
+        cached = self.cachedSchedule(sn, max_age)
+        if cached:
+            return cached
+        
+        with self.readLock(sn):
+            # Someone else may have read it while we waited
+            cached = self.cachedSchedule(sn, max_age, count_miss=False)
+            if cached:
+                return cached
+            
+            self.printDebug(f'SCHEDULE_CACHE: miss for {sn}')
+            return self.readChargeDischargeSchedule(sn, priority)
 
-    def printDebug(self, msg):
-        if self.debug:
-            print(msg)
+
+    def cachedSchedule(self, sn, max_age, count_miss=True):
+        ''' Return a copy of the cached schedule if it's younger than
+        max_age seconds, otherwise False
+        '''
+        with self.cache_lock:
+            entry = self.schedule_cache.get(sn, False)
+            if entry and (time.time() - entry['fetched']) < max_age:
+                self.cache_stats['hits'] += 1
+                self.printDebug(f'SCHEDULE_CACHE: hit for {sn}')
+                return copy.deepcopy(entry['timings'])
+            
+            if count_miss:
+                self.cache_stats['misses'] += 1
         
+        return False
 
-    def calculateDynamicTimeRange(self, end_hours = 3, exact = False):
-        ''' Calculate a time range to pass into the API
+
+    def readLock(self, sn):
+        ''' Return the lock which serialises cache-filling reads of sn
         '''
+        with self.cache_lock:
+            if sn not in self.read_locks:
+                self.read_locks[sn] = threading.Lock()
+            return self.read_locks[sn]
+
+
+    def getScheduleSnapshot(self, sn, max_age=None):
+        ''' Return the schedule along with its raw value and the time
+        it was fetched, reading it from the API if the cached copy is
+        older than max_age
         
-        now = datetime.datetime.now()
+        Returns a dict with keys timings, value and fetched, or False
+        '''
+        timings = self.getChargeDischargeSchedule(sn, max_age)
+        if not timings:
+            return False
         
-        hour_begin = now.replace(minute=0)
-        if not exact:
-            hour_end = hour_begin + datetime.timedelta(hours=end_hours)
-        else:
-            hour_end = hour_begin.replace(hour=exact['hour'], minute=exact['minute'])
+        return self.snapshotFrom(sn, timings)
+
+
+    def snapshotFrom(self, sn, timings):
+        ''' Build a snapshot, preferring the cache entry (which knows
+        when it was fetched)
+        '''
+        timings.pop('raw', None)
+        with self.cache_lock:
+            entry = self.schedule_cache.get(sn, False)
+            if entry:
+                return {"timings" : timings, "value" : entry['value'], "fetched" : entry['fetched']}
         
-        if int(hour_begin.strftime("%H")) > int(hour_end.strftime("%H")):
-            # Time wrapped
-            hour_end = hour_end.replace(hour=0, minute=0)
+        return {"timings" : timings, "value" : self.buildScheduleValue(timings), "fetched" : time.time()}
+
+
+    def cacheSchedule(self, sn, timings, value, fetched=None):
+        ''' Store a copy of an inverter's schedule in the cache
         
-        # Turn into a textual range
-        b = hour_begin.strftime("%H:%M")
-        e = hour_end.strftime("%H:%M")
+        fetched defaults to now
+        '''
+        with self.cache_lock:
+            self.schedule_cache[sn] = {
+                "timings" : copy.deepcopy(timings),
+                "value" : value,
+                "fetched" : fetched if fetched is not None else time.time()
+                }
+            previous = self.observed.get(sn, None)
+            self.observed[sn] = value
+        
+        if value != previous:
+            self.notifyScheduleChange(sn, timings, value, previous)
+
+
+    def addScheduleListener(self, fn):
+        ''' Register a callable to be invoked whenever a read or write
+        shows that an inverter's schedule has changed
         
-        return f"{b}-{e}"
+        It's called as fn(sn, timings, value, previous), where previous
+        is the last value seen (None if this is the first)
+        '''
+        self.schedule_listeners.append(fn)
+
+
+    def notifyScheduleChange(self, sn, timings, value, previous):
+        ''' Tell listeners about a schedule change
         
+        A failing listener mustn't break the read or write which
+        observed the change
+        '''
+        for fn in self.schedule_listeners:
+            try:
+                fn(sn, copy.deepcopy(timings), value, previous)
+            except Exception as e:
+                self.printDebug(f'SCHEDULE_LISTENER: listener failed: {e}')
 
-    def immediateStart(self, action="charge", hours=3, exact=False, rates=False):
-        ''' Immediately start an action
+
+    def invalidateSchedule(self, sn):
+        ''' Drop an inverter's schedule from the cache
+        
+        Used when we can no longer be sure of what the inverter holds
         '''
-               
-        timerange = self.calculateDynamicTimeRange(hours, exact)
-        self.printDebug(f'Generating a {action} timings payload for {timerange}')
+        with self.cache_lock:
+            self.schedule_cache.pop(sn, None)
+
+
+    def warmFromJournal(self, serials=False):
+        ''' Populate the cache from the most recent journal entry
+        for each inverter (defaults to the configured inverter)
         
-        # Get existing schedule and settings
-        timings = self.readChargeDischargeSchedule(self.config['inverter'])
+        Entries keep the time they were recorded, so the cache TTL
+        and elide_max_age still apply. If the last thing we did was
+        a write which failed or never completed, the inverter's state
+        is unknown and it's left to be read from the API
         
-        if not timings:
-            self.printDebug(f'Failed to fetch timings object')
-            if not self.config['do_retry']:
-                # Retries are disabled
-                return False
+        Returns the number of inverters warmed
+        '''
+        if not serials:
+            serials = [self.config['inverter']]
+        
+        latest = self.journal.latest()
+        warmed = 0
+        for sn in serials:
+            entry = latest.get(sn, False)
+            if not entry:
+                continue
             
-            self.printDebug(f'Will retry after {self.config["retry_delay_s"]}s')
-            time.sleep(self.config['retry_delay_s'])
-            timings = self.readChargeDischargeSchedule(self.config['inverter'])
-            if not timings:
-                # Out of luck
-                return False
+            if entry['status'] != "ok":
+                self.printDebug(f'JOURNAL: last write to {sn} was {entry["status"]}, state unknown')
+                self.journal_stats['uncertain'].append(sn)
+                continue
+            
+            timings = self.parseScheduleValue(entry['value'])
+            timings['raw'] = {
+                "code" : "0",
+                "msg" : "journal",
+                "data" : {"msg" : entry['value']}
+                }
+            self.cacheSchedule(sn, timings, entry['value'], fetched=entry['ts'])
+            self.printDebug(f'JOURNAL: warmed {sn} from {entry["op"]} at {entry["ts"]}')
+            warmed += 1
+        
+        self.journal_stats['warmed'] += warmed
+        return warmed
 
+
+    def journalRecord(self, method, *args):
+        ''' Call a ScheduleJournal method, if the journal is enabled
         
-        # Set the charge timing for the relevant slot
-        slot = f"slot{self.config['dynamic_slot']}"
-        
-        if action == "charge":
-            timings['slots'][slot]['charge'] = timerange;
-            timings['slots'][slot]['discharge'] = "00:00-00:00";
-        else:
-            timings['slots'][slot]['discharge'] = timerange;
-            timings['slots'][slot]['charge'] = "00:00-00:00";
-        
-        
-        if rates:
-            # The user also wants to change the rate
-            if "charge_current" in rates:
-                timings['charge_current'] = rates['charge_current']
-            if "discharge_current" in rates:
-                timings['discharge_current'] = rates['discharge_current']
-            
-        # Set the schedule
-        res2 = self.setChargeDischargeTimings(self.config['inverter'], timings)
+        Failure to write to the journal is logged but doesn't prevent
+        the inverter from being controlled
+        '''
+        if not self.journal:
+            return False
         
-        if not res2:
-            self.printDebug(f'Failed to set timings')
-            if not self.config['do_retry']:
-                # Retries are disabled
-                return False
-            
-            self.printDebug(f'Will retry after {self.config["retry_delay_s"]}s')
-            time.sleep(self.config['retry_delay_s'])
-            if not self.readChargeDischargeSchedule(self.config['inverter']):
-                # Out of luck
-                return False
+        try:
+            return getattr(self.journal, method)(*args)
+        except Exception as e:
+            self.printDebug(f'JOURNAL: {method} failed: {e}')
+            return False
+
 
+    def getJournalStats(self):
+        ''' Return journal statistics, or False if it's disabled
+        '''
+        if not self.journal:
+            return False
         
-        return True
+        stats = self.journal.getStats()
+        stats.update(self.journal_stats)
+        return stats
 
 
-    def immediateStop(self, rates=False):
-        ''' Immediately stop charging and discharging
+    def getCacheStats(self):
+        ''' Return schedule cache hit/miss statistics
         '''
-        # Get existing schedule and settings
-        timings = self.readChargeDischargeSchedule(self.config['inverter'])
+        with self.cache_lock:
+            stats = dict(self.cache_stats)
+            stats['entries'] = len(self.schedule_cache)
         
-        if not timings:
-            self.printDebug(f'Failed to fetch timings object')
-            if not self.config['do_retry']:
-                # Retries are disabled
-                return False
-            
-            self.printDebug(f'Will retry after {self.config["retry_delay_s"]}s')
-            time.sleep(self.config['retry_delay_s'])
-            timings = self.readChargeDischargeSchedule(self.config['inverter'])
-            if not timings:
-                # Out of luck
-                return False
-           
-        # Set the charge timing for the relevant slot
-        slot = f"slot{self.config['dynamic_slot']}"
-        timings['slots'][slot]['charge'] = "00:00-00:00";
-        timings['slots'][slot]['discharge'] = "00:00-00:00";
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] / lookups) if lookups else 0
+        return stats
+
+
+    def startScheduleRefresher(self, interval=None):
+        ''' Start a background thread which periodically re-reads the
+        schedule of each cached inverter (and the configured inverter)
+        so that control calls find a warm cache
         
-        if rates:
-            # The user also wants to change the rate
-            if "charge_current" in rates:
-                timings['charge_current'] = rates['charge_current']
-            if "discharge_current" in rates:
-                timings['discharge_current'] = rates['discharge_current']
+        Each refresh costs one request from the rate limit budget
+        '''
+        if interval is None:
+            interval = self.config.get('schedule_refresh_interval', 0)
         
-        # Set the schedule
-        res2 = self.setChargeDischargeTimings(self.config['inverter'], timings)
+        if not interval or self.refresher:
+            return False
         
-        if not res2:
-            self.printDebug(f'Failed to set timings')
-            if not self.config['do_retry']:
-                # Retries are disabled
-                return False
-            
-            self.printDebug(f'Will retry after {self.config["retry_delay_s"]}s')
-            time.sleep(self.config['retry_delay_s'])
-            if not self.readChargeDischargeSchedule(self.config['inverter']):
-                # Out of luck
-                return False
+        def refresh():
+            while True:
+                with self.cache_lock:
+                    serials = set(self.schedule_cache.keys())
+                
+                if "inverter" in self.config:
+                    serials.add(self.config['inverter'])
+                
+                for sn in serials:
+                    try:
+                        if self.readChargeDischargeSchedule(sn):
+                            with self.cache_lock:
+                                self.cache_stats['refreshes'] += 1
+                    except Exception as e:
+                        self.printDebug(f'SCHEDULE_CACHE: refresh of {sn} failed: {e}')
+                
+                time.sleep(interval)
         
+        self.refresher = threading.Thread(target=refresh, daemon=True)
+        self.refresher.start()
         return True
-    
-    
-    def readChargeDischargeSchedule(self, sn):
-        ''' Place a request to the API to read the charge schedule settings
-        '''
+
+
+    def setChargeDischargeTimings(self, sn, timings, force=False, verify=None):
+        ''' Set charge and discharge rate and timings
         
-        # Construct the request body
-        req_body_d = {
-                "inverterSn": sn,
-                "cid" : 103
-            }
-        req_body = json.dumps(req_body_d)
-        req_path = "/v2/api/atRead"
+        This expects a dict in the same format as that returned by 
+        readChargeDischargeSchedule with the exception that it doesn't
+        require the raw attribute (which will be ignored if present)
         
-        # Construct an auth header
-        headers = self.doAuth(self.config['api_id'], self.config['api_secret'], req_path, req_body)
-                
-        self.printDebug(f'Built request - Headers {headers}, body: {req_body}, path: {req_path}')
-               
-        # Place the request
-        r = self.postRequest(
-            f"{self.config['api_url']}{req_path}",
-            headers,
-            req_body
-            )
+        If the resulting value matches what we last saw on the inverter
+        the write is skipped (unless force is True) and the returned dict
+        will have elided set to True
         
-        resp = r.json()
-        self.printDebug(f'Got response: {resp}')
+        If verify is True (defaults to the verify_writes config setting)
+        the schedule is read back until it reflects the write (see
+        verifyWrite). If it doesn't within verify_timeout, False is returned
+        '''
         
-        if not resp or "code" not in resp or resp["code"] != "0":
+        if not self.validateTimingsObj(timings):
+            # It _probably_ threw an exception so we'll never get here
             return False
         
+        value = self.buildScheduleValue(timings)
+        self.printDebug(f'Schedule value: {value}')
+        
+        if not force:
+            elided = self.checkElision(sn, value)
+            if elided:
+                return elided
+        
+        journal_id = self.journalRecord("beginWrite", sn, value)
+        try:
+            resp = self.apiCall("/v2/api/control", {
+                    "inverterSn": sn,
+                    "cid" : 103,
+                    "value" : value
+                })
+        except Exception:
+            self.abandonWrite(sn, journal_id)
+            raise
+        
+        resp = self.processControlResponse(sn, value, resp, journal_id)
+        
+        if verify is None:
+            verify = self.config.get('verify_writes', False)
+        
+        if resp and verify:
+            resp.update(self.verifyWrite(sn, value))
+            if not resp['verified']:
+                return False
         
-        # Process the response
-        timings = {}
+        return resp
+
+
+    def verifyWrite(self, sn, value, timeout=None):
+        ''' Read the schedule back until it matches value, or timeout
+        (defaults to verify_timeout) seconds pass
         
-        '''
-        The returned string looks like this
-        20,55,00:00-06:00,00:00-00:00,0,0,12:00-16:00,00:00-00:00,0,0,00:00-00:00,00:00-00:00
+        The first poll is timed using a moving average of how long
+        previous writes took to apply. Subsequent polls back off, and
+        are never closer together than needed to stay within
+        verify_budget (a fraction) of the rate limit
         
-        We need to take the first two values (charge and discharge current, respectively) and
-        then iterate through the timeslots
+        Polls don't touch the cache (which already holds the value just
+        written) or the journal: until the write applies they'd only see
+        the old schedule. See recordVerification
+        
+        Returns a dict with keys verified, time_to_apply and verify_polls
         '''
-        slots = resp['data']['msg'].split(',')
-        timings['charge_current'] = slots[0]
-        timings['discharge_current'] = slots[1]
+        start = time.time()
+        deadline = start + (timeout if timeout is not None else self.config.get('verify_timeout', 30))
+        delay, min_interval = self.verifySchedule()
+        interval = min_interval
+        polls = 0
+        last = False
         
-        timings["slots"] = {
-            "slot1": { "charge": slots[2], "discharge": slots[3]},
-            "slot2": { "charge": slots[6], "discharge": slots[7]},
-            "slot3": { "charge": slots[10], "discharge": slots[11]}
-            }
+        while True:
+            time.sleep(max(0, min(delay, deadline - time.time())))
+            polls += 1
+            try:
+                resp = self.fetchScheduleResponse(sn, PRIORITY_READ_BEFORE_WRITE)
+            except SolisCloudError as e:
+                self.printDebug(f'VERIFY: poll of {sn} failed: {e}')
+                break
+            
+            timings = self.parseScheduleResponse(resp)
+            if timings:
+                last = resp
+                if self.scheduleMatches(timings, value):
+                    return self.recordVerification(sn, True, time.time() - start, polls, last)
+            
+            if time.time() >= deadline:
+                break
+            
+            delay = interval
+            interval = min(interval * 2, min_interval * 4)
         
-        timings['raw'] = resp
+        return self.recordVerification(sn, False, time.time() - start, polls, last)
+
+
+    def verifySchedule(self):
+        ''' Return the delay before the first verification poll and
+        the minimum interval between subsequent ones
+        '''
+        budget = self.config.get('verify_budget', 0.5) or 1
+        return (self.apply_estimate or 0), 1 / (self.ratelimiter.maxThroughput() * budget)
+
+
+    def scheduleMatches(self, timings, value):
+        ''' Check whether a schedule read from the API reflects value
         
-        return timings
+        The comparison is made on the normalised value so that fields
+        which aren't used (or are formatted differently) don't matter
+        '''
+        return self.buildScheduleValue(timings) == value
 
 
-    def setChargeDischargeTimings(self, sn, timings):
-        ''' Set charge and discharge rate and timings
+    def recordVerification(self, sn, verified, elapsed, polls, last=False):
+        ''' Update statistics and metrics following verification
         
-        This expects a dict in the same format as that returned by 
-        readChargeDischargeSchedule with the exception that it doesn't
-        require the raw attribute (which will be ignored if present)
+        last is the final successful poll's response. It shows what the
+        inverter holds now, so it's what the cache and journal are
+        updated with. If no poll succeeded, we no longer know
         '''
+        if last:
+            self.processScheduleResponse(sn, last)
+        else:
+            self.invalidateSchedule(sn)
+        
+        with self.cache_lock:
+            if verified:
+                self.write_stats['verified'] += 1
+                # Weight recent writes more heavily
+                self.apply_estimate = elapsed if not self.apply_estimate else (0.7 * self.apply_estimate + 0.3 * elapsed)
+            else:
+                self.write_stats['unverified'] += 1
+        
+        if verified:
+            WRITE_APPLY_TIME.observe(elapsed)
+            self.printDebug(f'VERIFY: {sn} applied after {elapsed:.2f}s ({polls} polls)')
+        else:
+            self.printDebug(f'VERIFY: {sn} not applied after {elapsed:.2f}s ({polls} polls)')
+        WRITE_VERIFY.inc(result="verified" if verified else "unverified")
         
-        if not self.validateTimingsObj(timings):
-            # It _probably_ threw an exception so we'll never get here
-            return False
+        return {
+            "verified" : verified,
+            "time_to_apply" : elapsed if verified else None,
+            "verify_polls" : polls
+            }
+
+
+    def buildScheduleValue(self, timings):
+        ''' Build the cid 103 value string from a timings dict
         
-        # Build the value        
+        This is the inverse of parseScheduleValue
+        '''
         value_l = [
             str(timings['charge_current']),
             str(timings['discharge_current'])
@@ -420,86 +1848,111 @@ class SolisCloud:
         
         for l in timings['slots']:
             if len(value_l) > 2:
-                value_l = value_l + ["0","0"]
+                value_l.extend(["0","0"])
             
             value_l.append(timings['slots'][l]["charge"])
             value_l.append(timings['slots'][l]["discharge"])
         
-        value = ",".join(value_l)
-        print(value)
-        # Construct the request payload
-        req_body_d = {
-                "inverterSn": sn,
-                "cid" : 103,
-                "value" : value
-            }
-        req_body = json.dumps(req_body_d)
-        req_path = "/v2/api/control"
+        return ",".join(value_l)
+
+
+    def checkElision(self, sn, value):
+        ''' Check whether writing value would be a no-op
         
-        # Construct an auth header
-        headers = self.doAuth(self.config['api_id'], self.config['api_secret'], req_path, req_body)
-                
-        self.printDebug(f'Built request - Headers {headers}, body: {req_body}, path: {req_path}')
+        Compares against the last value read from (or written to) the
+        inverter, provided that's no older than elide_max_age seconds
         
-        # Place the request
-        r = self.postRequest(
-            f"{self.config['api_url']}{req_path}",
-            headers,
-            req_body
-            )
+        Returns a response dict if the write can be skipped, otherwise False
+        '''
+        max_age = self.config.get('elide_max_age', 0)
+        if not max_age:
+            return False
         
-        resp = r.json()
-        self.printDebug(f'Got response: {resp}')
+        with self.cache_lock:
+            entry = self.schedule_cache.get(sn, False)
+            if not entry or entry['value'] != value or (time.time() - entry['fetched']) >= max_age:
+                return False
+            
+            self.write_stats['elided'] += 1
+        
+        self.printDebug(f'Schedule for {sn} is already {value}, skipping write')
+        return {
+            "code" : "0",
+            "msg" : "elided",
+            "elided" : True
+            }
+
+
+    def getWriteStats(self):
+        ''' Return counts of writes placed, elided and verified
+        '''
+        with self.cache_lock:
+            stats = dict(self.write_stats)
+            stats['apply_estimate'] = self.apply_estimate or 0
+            return stats
+
+
+    def abandonWrite(self, sn, journal_id=False):
+        ''' A write was interrupted by an exception (an earlier attempt
+        may have reached the inverter) so forget what we knew
+        '''
+        self.invalidateSchedule(sn)
+        if journal_id:
+            self.journalRecord("finishWrite", journal_id, False)
+
+
+    def processControlResponse(self, sn, value, resp, journal_id=False):
+        ''' Check the response to a control request and
+        update the cache (and journal) accordingly
+        '''
+        with self.cache_lock:
+            self.write_stats['writes'] += 1
         
+        ok = resp and "code" in resp and resp["code"] == "0"
+        if journal_id:
+            self.journalRecord("finishWrite", journal_id, ok)
         
-        if not resp or "code" not in resp or resp["code"] != "0":
+        if not ok:
+            # We don't know what state the inverter was left in
+            self.invalidateSchedule(sn)
             return False
         
+        # Write through to the cache so that the next control call
+        # doesn't need to read the schedule back
+        new_timings = self.parseScheduleValue(value)
+        new_timings['raw'] = resp
+        self.cacheSchedule(sn, new_timings, value)
+        
         return resp
 
     def setCurrents(self, rates):
         ''' Set the charge and discharge rates
         '''
-        
-        # Get existing schedule and settings
-        timings = self.readChargeDischargeSchedule(self.config['inverter'])
-        
-        if not timings:
-            self.printDebug(f'Failed to fetch timings object')
-            if not self.config['do_retry']:
-                # Retries are disabled
-                return False
-            
-            self.printDebug(f'Will retry after {self.config["retry_delay_s"]}s')
-            time.sleep(self.config['retry_delay_s'])
-            timings = self.readChargeDischargeSchedule(self.config['inverter'])
-            if not timings:
-                # Out of luck
-                return False
+        return self.updateSchedule(lambda timings: self.applyRates(timings, rates))
 
-        if "charge_current" in rates:
-            timings["charge_current"] = rates["charge_current"]
-            
-        if "discharge_current" in rates:
-            timings["discharge_current"] = rates["discharge_current"]
-        
-        # Write it back
-        # Set the schedule
-        res2 = self.setChargeDischargeTimings(self.config['inverter'], timings)
+    def applyWindows(self, windows, rates=False, overflow="defer"):
+        ''' Replace the schedule with a set of charge/discharge windows
+        in a single write
+        
+        windows is a list of dicts with keys action (charge or discharge),
+        start and end (see slots.SlotPacker). Overlapping and adjacent
+        windows are merged; if there are still more than fit in the
+        slots, overflow decides whether the later windows are deferred
+        or the closest windows are merged together
+        
+        Returns a tuple of the result and a list of the windows which
+        were deferred (and so still need to be written later)
+        '''
+        packer = SlotPacker().addWindows(windows)
+        deferred = []
         
-        if not res2:
-            self.printDebug(f'Failed to set currents')
-            if not self.config['do_retry']:
-                # Retries are disabled
-                return False
-            
-            self.printDebug(f'Will retry after {self.config["retry_delay_s"]}s')
-            time.sleep(self.config['retry_delay_s'])
-            if not self.readChargeDischargeSchedule(self.config['inverter']):
-                # Out of luck
-                return False
+        def mutate(timings):
+            slots, d = packer.pack(overflow=overflow)
+            timings['slots'] = slots
+            deferred[:] = d
+            self.applyRates(timings, rates)
         
-        return True
+        return self.updateSchedule(mutate), deferred
         
     def startCharge(self, hours=3, exact=False, rates=False):
         ''' Start a charge immediately
@@ -532,6 +1985,101 @@ class SolisCloud:
         '''
         return self.immediateStop(rates)
         
+    def getInverterDetail(self, sn=False, inverter_id=False):
+        ''' Fetch current telemetry for an inverter, by serial or
+        Soliscloud id (defaults to the configured inverter)
+        
+        Returns the data dict from the response, or False on failure
+        '''
+        body = {}
+        if sn:
+            body['sn'] = sn
+        if inverter_id:
+            body['id'] = inverter_id
+        if not body:
+            body['sn'] = self.config['inverter']
+        
+        resp = self.apiCall("/v1/api/inverterDetail", body)
+        if not resp or "code" not in resp or resp["code"] != "0":
+            self.printDebug(f'Failed to fetch detail for {body}: {resp}')
+            return False
+        
+        return resp['data']
+
+
+    def iterInverterList(self, page_size=100, station_id=False):
+        ''' Iterate over the inverters on the account (or station),
+        fetching one page at a time
+        
+        Each record includes headline telemetry (power, generation,
+        battery state of charge etc) so, for many inverters, this is
+        far cheaper than calling getInverterDetail for each
+        
+        Raises SolisCloudError if a page can't be fetched, rather than
+        silently returning a partial list
+        '''
+        page = 1
+        while True:
+            body = {"pageNo" : page, "pageSize" : page_size}
+            if station_id:
+                body['stationId'] = station_id
+            
+            resp = self.apiCall("/v1/api/inverterList", body)
+            if not resp or "code" not in resp or resp["code"] != "0":
+                raise SolisCloudError(f'Failed to fetch page {page} of the inverter list: {resp}')
+            
+            data = resp['data']['page']
+            yield from data['records']
+            
+            if not data['records'] or page >= int(data.get('pages', 1)):
+                return
+            page += 1
+
+
+    def iterInverterDetails(self, serials=False):
+        ''' Fetch the detail of each inverter in turn (defaults
+        to the configured inverters), skipping any which fail
+        '''
+        for sn in serials or self.config['inverters']:
+            detail = self.getInverterDetail(sn)
+            if detail:
+                yield detail
+
+
+    def getInverterMonth(self, sn, month, time_zone=0):
+        ''' Fetch per-day energy history for a month (YYYY-MM)
+        
+        Returns a list of per-day records, or False on failure
+        '''
+        return self.getInverterHistory("/v1/api/inverterMonth", {
+                "sn" : sn,
+                "month" : month,
+                "timeZone" : time_zone
+            })
+
+
+    def getInverterYear(self, sn, year, time_zone=0):
+        ''' Fetch per-month energy history for a year (YYYY)
+        
+        Returns a list of per-month records, or False on failure
+        '''
+        return self.getInverterHistory("/v1/api/inverterYear", {
+                "sn" : sn,
+                "year" : str(year),
+                "timeZone" : time_zone
+            })
+
+
+    def getInverterHistory(self, req_path, body):
+        resp = self.apiCall(req_path, body)
+        if not resp or "code" not in resp or resp["code"] != "0":
+            self.printDebug(f'Failed to fetch {req_path} for {body}: {resp}')
+            return False
+        
+        # Periods without data come back as null rather than []
+        return resp['data'] or []
+
+
     def validateTimingsObj(self, timings):
         ''' Ensure that the timings dict meets the expectations of this class
         
@@ -563,7 +2111,7 @@ class SolisCloud:
                     raise ValueError(f'timings validation failed: {slot} lacking {t}')
                     return False
                 
-                if not re.match("[0-2][0-9]:[0-5][0-9]-[0-2][0-9]:[0-5][0-9]", timings["slots"][slot][t]):
+                if not TIMERANGE_RE.match(timings["slots"][slot][t]):
                     raise ValueError(f'timings validation failed: {slot} {t} is not formatted as HH:MM-HH:MM')
                     return False
                     
@@ -580,8 +2128,13 @@ class SolisCloud:
 def configFromEnv():
     ''' Build a dict of configuration settings based on environment variables
     '''
+    inverter = os.getenv("INVERTER_SERIAL", "aaa-bbb-ccc")
+    
     return {
-        "inverter" : os.getenv("INVERTER_SERIAL", "aaa-bbb-ccc"),
+        "inverter" : inverter,
+        
+        # Used when controlling a fleet of inverters (see fleet.py)
+        "inverters" : [x.strip() for x in os.getenv("INVERTER_SERIALS", inverter).split(",") if x.strip()],
         
         # Which time slot to use when dynamically generating times
         "dynamic_slot" : os.getenv("DYNAMIC_SLOT", "3"),
@@ -589,17 +2142,86 @@ def configFromEnv():
         "api_id" : int(os.getenv("API_ID", 1234)),
         "api_secret" : os.getenv("API_SECRET", "abcde"),
         "api_url" : os.getenv("API_URL", "https://www.soliscloud.com:13333").strip('/'),
-        # Max number of requests per second
-        "api_rate_limit" : int(os.getenv("API_RATE_LIMIT", 2)),
-        
-        # Should we retry, and if so, what's the delay?
+        # Max number of requests per API_RATE_LIMIT_WINDOW seconds
+        # The API docs say 3 requests every 5 seconds
+        "api_rate_limit" : int(os.getenv("API_RATE_LIMIT", 3)),
+        "api_rate_limit_window" : float(os.getenv("API_RATE_LIMIT_WINDOW", 5)),
+        
+        # Learn the real limit, starting from the above: grow the allowed
+        # rate by rate_limit_increase req/s after each window's worth of
+        # successes and multiply it by rate_limit_decrease when throttled.
+        # The learned rate is saved in rate_limit_state_file, if set
+        "adaptive_rate_limit" : os.getenv("ADAPTIVE_RATE_LIMIT", "false").lower() == "true",
+        "rate_limit_min" : float(os.getenv("RATE_LIMIT_MIN", 0.1)),
+        "rate_limit_max" : float(os.getenv("RATE_LIMIT_MAX", 0)) or None,
+        "rate_limit_increase" : float(os.getenv("RATE_LIMIT_INCREASE", 0.05)),
+        "rate_limit_decrease" : float(os.getenv("RATE_LIMIT_DECREASE", 0.5)),
+        "rate_limit_state_file" : os.getenv("RATE_LIMIT_STATE_FILE", "") or None,
+        
+        # Response codes (in addition to HTTP 429) which mean we're being throttled
+        "throttle_codes" : [x.strip() for x in os.getenv("THROTTLE_CODES", "").split(",") if x.strip()],
+        
+        # Should we retry, and if so, how?
+        #
+        # The delay before each retry doubles (up to retry_max_delay), with up
+        # to retry_jitter (a fraction) of it randomly removed
         "do_retry" : os.getenv("RETRIES_ENABLED", "true").lower() == "true",
-        "retry_delay_s" : int(os.getenv("RETRY_DELAY", 3)),
+        "retry_max_attempts" : int(os.getenv("RETRY_MAX_ATTEMPTS", 2)),
+        "retry_delay_s" : float(os.getenv("RETRY_DELAY", 3)),
+        "retry_max_delay" : float(os.getenv("RETRY_MAX_DELAY", 30)),
+        "retry_jitter" : float(os.getenv("RETRY_JITTER", 0.5)),
+        
+        # Response codes which indicate that retrying won't help
+        "retry_fatal_codes" : [x.strip() for x in os.getenv("RETRY_FATAL_CODES", "").split(",") if x.strip()],
+        
+        # Stop placing requests for circuit_reset_s seconds after
+        # circuit_threshold consecutive failures. 0 disables
+        "circuit_threshold" : int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", 5)),
+        "circuit_reset_s" : float(os.getenv("CIRCUIT_BREAKER_RESET", 60)),
         
         # This is a safety net - maximum seconds to wait if we believe we'll
-        # hit the rate limit. As long as this is higher than api_rate_limit it
-        # should never actually be hit unless there's a bug.
-        "max_ratelimit_wait" : int(os.getenv("API_RATE_LIMIT_MAXWAIT", 8))
+        # hit the rate limit. As long as this is higher than api_rate_limit_window
+        # it should only be hit if requests are being placed faster than they can
+        # be serviced. When exceeded, RateLimitExceeded is raised
+        "max_ratelimit_wait" : int(os.getenv("API_RATE_LIMIT_MAXWAIT", 8)),
+        
+        # Connection handling: timeouts (in seconds) for establishing a
+        # connection and for waiting for a response, and the maximum number
+        # of connections to keep open
+        "connect_timeout" : float(os.getenv("API_CONNECT_TIMEOUT", 5)),
+        "read_timeout" : float(os.getenv("API_READ_TIMEOUT", 30)),
+        "pool_size" : int(os.getenv("API_POOL_SIZE", 10)),
+        
+        # How long (in seconds) a cached copy of the charge schedule can be
+        # used before it must be read from the API again. 0 disables the cache
+        "schedule_cache_ttl" : float(os.getenv("SCHEDULE_CACHE_TTL", 60)),
+        
+        # If non-zero, refresh the cached schedule in the background
+        # every n seconds
+        "schedule_refresh_interval" : float(os.getenv("SCHEDULE_REFRESH_INTERVAL", 0)),
+        
+        # Skip writes which wouldn't change the schedule, provided that our
+        # knowledge of it is no older than this many seconds. 0 disables
+        "elide_max_age" : float(os.getenv("ELIDE_MAX_AGE", 60)),
+        
+        # If set, schedule reads and writes are recorded in a SQLite
+        # database at this path and used to warm the cache at startup
+        "journal_path" : os.getenv("JOURNAL_PATH", ""),
+        
+        # How many journal entries to retain per inverter
+        "journal_keep" : int(os.getenv("JOURNAL_KEEP", 100)),
+        
+        # Queued requests move up a priority class for every n seconds
+        # they've been waiting, so that background work isn't starved
+        "scheduler_aging" : float(os.getenv("SCHEDULER_AGING", 10)),
+        
+        # Read the schedule back after each write until it's applied, giving
+        # up (and treating the write as failed) after verify_timeout seconds
+        "verify_writes" : os.getenv("VERIFY_WRITES", "false").lower() == "true",
+        "verify_timeout" : float(os.getenv("VERIFY_TIMEOUT", 30)),
+        
+        # Fraction of the rate limit which verification polls may use
+        "verify_budget" : float(os.getenv("VERIFY_BUDGET", 0.5))
         }
 
 
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#
+# Telemetry
+#
+# Turns inverter telemetry (from SolisCloud.iterInverterList or
+# iterInverterDetails) into batches of InfluxDB line protocol
+# or newline delimited JSON
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+'''
+Copyright (c) 2023, B Tasker
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this list of
+conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, this list of
+conditions and the following disclaimer in the documentation and/or other materials
+provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors may be used
+to endorse or promote products derived from this software without specific prior written
+permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import json
+import os
+import sys
+import time
+
+import soliscloud_control
+
+
+# Record attributes written as tags (if present), rather than fields
+TAG_KEYS = ["sn", "stationId"]
+
+# Numeric attributes which aren't measurements
+SKIP_FIELDS = ["id", "state", "dataTimestamp"]
+
+
+def escapeKey(s):
+    ''' Escape a measurement name, tag key/value or field key
+    for line protocol
+    '''
+    return str(s).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def toLineProtocol(record, measurement="solis_inverter"):
+    ''' Build a line protocol line from a telemetry record
+
+    All numeric attributes become fields. They're written as floats,
+    because the API doesn't consistently return (for example) 0 rather
+    than 0.0, and InfluxDB rejects a change of field type
+
+    Returns False if the record has no numeric attributes
+    '''
+    tags = "".join(f",{k}={escapeKey(record[k])}" for k in TAG_KEYS if record.get(k, "") != "")
+
+    fields = []
+    for k, v in record.items():
+        if k in SKIP_FIELDS or k in TAG_KEYS or isinstance(v, bool) or not isinstance(v, (int, float)):
+            continue
+        fields.append(f"{escapeKey(k)}={float(v)}")
+
+    if not fields:
+        return False
+
+    line = f"{escapeKey(measurement)}{tags} {','.join(fields)}"
+
+    # dataTimestamp is when the inverter reported, in milliseconds
+    if str(record.get("dataTimestamp", "")).isdigit():
+        line += f" {int(record['dataTimestamp']) * 1000000}"
+
+    return line
+
+
+def toNDJSON(record):
+    ''' Serialise a telemetry record as a single line of JSON
+    '''
+    return json.dumps(record, separators=(",", ":"))
+
+
+FORMATTERS = {
+    "line" : toLineProtocol,
+    "ndjson" : toNDJSON
+    }
+
+
+def batches(records, fmt="line", batch_size=500):
+    ''' Consume an iterable of records, yielding newline terminated
+    strings of up to batch_size formatted lines
+
+    Records are formatted as they arrive, so memory use is bounded
+    by the batch size however many records there are
+    '''
+    formatter = FORMATTERS[fmt]
+    batch = []
+    for record in records:
+        line = formatter(record)
+        if not line:
+            continue
+
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield "\n".join(batch) + "\n"
+            batch = []
+
+    if batch:
+        yield "\n".join(batch) + "\n"
+
+
+if __name__ == "__main__":
+    # Poll telemetry and write batches to stdout, for example
+    #
+    #   telemetry.py | influx write --bucket solis
+    #
+    DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+    FORMAT = os.getenv("TELEMETRY_FORMAT", "line")
+    BATCH_SIZE = int(os.getenv("TELEMETRY_BATCH_SIZE", 500))
+
+    # list: page through inverterList (one request per 100 inverters)
+    # detail: call inverterDetail for each of INVERTER_SERIALS
+    SOURCE = os.getenv("TELEMETRY_SOURCE", "list")
+
+    # If non-zero, poll every n seconds rather than once
+    INTERVAL = float(os.getenv("TELEMETRY_INTERVAL", 0))
+
+    if FORMAT not in FORMATTERS:
+        print(f"TELEMETRY_FORMAT should be one of {list(FORMATTERS.keys())}", file=sys.stderr)
+        sys.exit(1)
+
+    # Batches are the only thing which may go to stdout: anything else
+    # that's printed (such as debug output) would corrupt the stream
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    config = soliscloud_control.configFromEnv()
+    soliscloud = soliscloud_control.SolisCloud(config, debug=DEBUG)
+
+    while True:
+        start = time.time()
+        records = soliscloud.iterInverterList() if SOURCE == "list" else soliscloud.iterInverterDetails()
+        try:
+            for batch in batches(records, FORMAT, BATCH_SIZE):
+                out.write(batch)
+                out.flush()
+        except soliscloud_control.SolisCloudError as e:
+            print(f"Poll failed: {e}", file=sys.stderr)
+            if not INTERVAL:
+                sys.exit(1)
+
+        if not INTERVAL:
+            break
+        time.sleep(max(0, INTERVAL - (time.time() - start)))
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+#
+# WSGI entrypoint for the control server
+#
+# For example
+#
+#    gunicorn --workers 1 --threads 16 --chdir app wsgi:app
+#
+# Use a single worker process: each process has its own rate
+# limit budget and command queue, so multiple workers would
+# collectively exceed Soliscloud's per-IP limit
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+import server
+
+app = server.setup()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmarks for the per-request CPU path in soliscloud_control
+#
+# Every request to the API is signed (doAuth) and every control
+# write involves parsing, validating and rebuilding a schedule,
+# so across a fleet these add up. This times each of them so that
+# growth in that overhead is noticed.
+#
+# Examples
+#
+#    benchmark.py                       # print timings
+#    benchmark.py --save                # record timings as the baseline
+#    benchmark.py --compare             # compare against the baseline, exit 1 on regression
+#    benchmark.py --compare --threshold 0.1 --only doAuth
+#
+# Timings are machine dependent, so a baseline should be recorded
+# on the same machine that comparisons are run on
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import soliscloud_control
+
+
+SCHEDULE_VALUE = "20,55,00:00-06:00,00:00-00:00,0,0,12:00-16:00,00:00-00:00,0,0,00:00-00:00,16:00-19:00"
+
+
+def buildBenchmarks():
+    ''' Return a dict of benchmark name to a zero-argument callable
+    '''
+    config = soliscloud_control.configFromEnv()
+    config['schedule_cache_ttl'] = 0
+    soliscloud = soliscloud_control.SolisCloud(config)
+
+    sn = config['inverter']
+    read_body = json.dumps({"inverterSn" : sn, "cid" : 103})
+    read_resp = {"code" : "0", "msg" : "success", "data" : {"msg" : SCHEDULE_VALUE}}
+    timings = soliscloud.parseScheduleValue(SCHEDULE_VALUE)
+
+    return {
+        # Signing, with the date generated as it would be for a real request
+        "doAuth" : lambda: soliscloud.doAuth(config['api_id'], config['api_secret'],
+                        "/v2/api/atRead", read_body),
+        # Serialisation and signing
+        "buildRequest" : lambda: soliscloud.buildRequest("/v2/api/atRead", {"inverterSn" : sn, "cid" : 103}),
+        # What readChargeDischargeSchedule does with a response (including caching it)
+        "processScheduleResponse" : lambda: soliscloud.processScheduleResponse(sn, read_resp),
+        "parseScheduleValue" : lambda: soliscloud.parseScheduleValue(SCHEDULE_VALUE),
+        "validateTimingsObj" : lambda: soliscloud.validateTimingsObj(timings),
+        # Value string construction in setChargeDischargeTimings
+        "buildScheduleValue" : lambda: soliscloud.buildScheduleValue(timings),
+        # A full read-modify-build cycle, minus the network
+        "updateCycle" : lambda: soliscloud.buildScheduleValue(
+                            updateTimings(soliscloud, soliscloud.processScheduleResponse(sn, read_resp)))
+        }
+
+
+def updateTimings(soliscloud, timings):
+    ''' Apply the same mutation as stopCharge and validate the result
+    '''
+    soliscloud.setSlotAction(timings, "stop")
+    soliscloud.validateTimingsObj(timings)
+    return timings
+
+
+def timeBenchmark(fn, repeat, number):
+    ''' Return the best observed time per call, in microseconds
+
+    The minimum is used because it's the least affected by
+    whatever else the machine happens to be doing
+    '''
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number * 1e6
+
+
+def run(only=False, repeat=5, number=5000):
+    ''' Run the benchmarks, returning a dict of name to microseconds per call
+    '''
+    results = {}
+    for name, fn in buildBenchmarks().items():
+        if only and name not in only:
+            continue
+        results[name] = timeBenchmark(fn, repeat, number)
+    return results
+
+
+def compare(results, baseline, threshold):
+    ''' Compare results against a baseline
+
+    Returns a list of (name, baseline, current, change) tuples, and a list
+    of the names which slowed down by more than threshold (a fraction)
+    '''
+    rows = []
+    regressions = []
+    for name, current in results.items():
+        if name not in baseline:
+            rows.append((name, None, current, None))
+            continue
+
+        change = (current - baseline[name]) / baseline[name]
+        rows.append((name, baseline[name], current, change))
+        if change > threshold:
+            regressions.append(name)
+
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the soliscloud_control hot path")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="Baseline file")
+    parser.add_argument("--save", action="store_true", help="Save the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare against the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown (as a fraction) treated as a regression")
+    parser.add_argument("--only", action="append", help="Benchmark(s) to run, default all")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing runs per benchmark")
+    parser.add_argument("--number", type=int, default=5000, help="Calls per timing run")
+    args = parser.parse_args()
+
+    results = run(args.only, args.repeat, args.number)
+
+    if args.compare:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['results']
+
+        rows, regressions = compare(results, baseline, args.threshold)
+        for name, before, after, change in rows:
+            if before is None:
+                print(f"{name:<24} {'-':>10}   {after:8.2f}us  (no baseline)")
+                continue
+            flag = "  REGRESSION" if name in regressions else ""
+            print(f"{name:<24} {before:8.2f}us -> {after:8.2f}us  {change * 100:+6.1f}%{flag}")
+
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slowed by more than {args.threshold * 100:.0f}%")
+            sys.exit(1)
+    else:
+        for name, us in results.items():
+            print(f"{name:<24} {us:8.2f}us")
+
+    if args.save:
+        with open(args.baseline, "w") as fh:
+            json.dump({
+                "python" : platform.python_version(),
+                "machine" : platform.machine(),
+                "results" : results
+                }, fh, indent=2)
+        print(f"Saved baseline to {args.baseline}")
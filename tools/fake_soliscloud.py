@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+#
+# A local stand-in for the Soliscloud API
+#
+# Implements just enough of /v2/api/atRead and /v2/api/control
+# (cid 103) to allow the library and control server to be
+# exercised without touching a real inverter, along with
+# synthetic data for the /v1/api/inverterList, inverterDetail,
+# inverterMonth and inverterYear monitoring endpoints
+#
+# Requests are authenticated in the same way as the real API and
+# latency, errors and throttling can be injected:
+#
+#   FAKE_API_ID / FAKE_API_SECRET: credentials to accept (default 1234 / abcde)
+#   FAKE_LATENCY: mean response latency in seconds (default 0)
+#   FAKE_LATENCY_JITTER: +/- seconds of random variation in latency (default 0)
+#   FAKE_ERROR_RATE: fraction of requests which fail (default 0)
+#   FAKE_THROTTLE: requests allowed per FAKE_THROTTLE_WINDOW seconds, 0 disables (default 0)
+#   FAKE_THROTTLE_WINDOW: (default 5)
+#   FAKE_APPLY_DELAY: seconds before a written value is visible to atRead (default 0)
+#   FAKE_INVERTERS: number of inverters listed by inverterList (default 3)
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+
+from collections import deque
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeInverter:
+    ''' Holds the cid 103 value for each inverter
+    '''
+
+    DEFAULT = "20,55,00:00-00:00,00:00-00:00,0,0,00:00-00:00,00:00-00:00,0,0,00:00-00:00,00:00-00:00"
+
+    def __init__(self, apply_delay=0, inverters=3):
+        self.lock = threading.Lock()
+        self.apply_delay = apply_delay
+        self.values = {}
+        self.serials = [f"FAKE{i:08d}" for i in range(inverters)]
+
+        # Writes which haven't yet been applied by the "inverter"
+        self.pending = {}
+
+        self.stats = {
+            "atRead" : 0,
+            "control" : 0,
+            "inverterList" : 0,
+            "inverterDetail" : 0,
+            "inverterHistory" : 0,
+            "auth_failures" : 0,
+            "errors" : 0,
+            "throttled" : 0
+            }
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def read(self, sn):
+        with self.lock:
+            self.stats['atRead'] += 1
+            if sn in self.pending and self.pending[sn][0] <= time.time():
+                self.values[sn] = self.pending.pop(sn)[1]
+            return self.values.get(sn, self.DEFAULT)
+
+    def write(self, sn, value):
+        with self.lock:
+            self.stats['control'] += 1
+            if self.apply_delay:
+                self.pending[sn] = (time.time() + self.apply_delay, value)
+            else:
+                self.values[sn] = value
+
+    def detail(self, sn):
+        ''' Generate plausible telemetry for an inverter
+        '''
+        now = time.time()
+        pac = round(max(0, 3.5 * random.random()), 3)
+        return {
+            "id" : str(1000000 + (self.serials.index(sn) if sn in self.serials else 999)),
+            "sn" : sn,
+            "stationId" : "2000000",
+            "state" : 1,
+            "dataTimestamp" : str(int(now * 1000)),
+            "pac" : pac,
+            "pacStr" : "kW",
+            "eToday" : round(now % 86400 / 3600 * 0.8, 2),
+            "eTodayStr" : "kWh",
+            "eTotal" : 12345.6,
+            "eTotalStr" : "kWh",
+            "batteryCapacitySoc" : round(random.uniform(10, 100), 1),
+            "batteryPower" : round(random.uniform(-3, 3), 3),
+            "familyLoadPower" : round(random.uniform(0.2, 4), 3),
+            "psum" : round(random.uniform(-3, 3), 3),
+            "inverterTemperature" : round(random.uniform(20, 45), 1)
+            }
+
+    def history(self, sn, period):
+        ''' Generate an energy history record for a day (YYYY-MM-DD)
+        or month (YYYY-MM)
+
+        Values are derived from the serial and period, so repeated
+        requests return the same data
+        '''
+        rnd = random.Random(f"{sn}{period}")
+        scale = 30 if len(period) == 7 else 1
+        energy = round(rnd.uniform(2, 25) * scale, 1)
+        return {
+            "dateStr" : period,
+            "energy" : energy,
+            "energyStr" : "kWh",
+            "gridPurchasedEnergy" : round(rnd.uniform(1, 15) * scale, 1),
+            "gridSellEnergy" : round(rnd.uniform(0, energy / 2), 1),
+            "homeLoadEnergy" : round(rnd.uniform(5, 20) * scale, 1),
+            "batteryChargeEnergy" : round(rnd.uniform(0, 10) * scale, 1),
+            "batteryDischargeEnergy" : round(rnd.uniform(0, 10) * scale, 1)
+            }
+
+
+class Throttle:
+    ''' Sliding window request counter, used to emulate
+    the API's "3 requests every 5 seconds" limit
+    '''
+
+    def __init__(self, limit=0, window=5):
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.seen = deque()
+
+    def allow(self):
+        if not self.limit:
+            return True
+
+        with self.lock:
+            now = time.time()
+            while self.seen and self.seen[0] <= now - self.window:
+                self.seen.popleft()
+
+            if len(self.seen) >= self.limit:
+                return False
+
+            self.seen.append(now)
+            return True
+
+
+def expectedSignature(secret, method, md5_str, content_type, date, path):
+    ''' Calculate the signature a correctly signed request should carry
+
+    This is implemented independently of SolisCloud.doAuth so that
+    it genuinely checks the client's implementation
+    '''
+    signstr = f"{method}\n{md5_str}\n{content_type}\n{date}\n{path}"
+    digest = hmac.new(secret.encode(), signstr.encode(), hashlib.sha1).digest()
+    return base64.b64encode(digest).decode()
+
+
+class FakeSolisHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are written separately, so without this
+    # delayed ACKs add ~40ms to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            super().log_message(format, *args)
+
+    def sendJSON(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        ''' Expose request counters, for use by benchmarks
+        '''
+        if self.path == "/stats":
+            self.sendJSON(self.server.inverters.stats)
+        else:
+            self.sendJSON({"code" : "404"}, 404)
+
+    def checkAuth(self, body):
+        ''' Verify the Content-MD5 and Authorization headers
+        '''
+        server = self.server
+        md5_str = base64.b64encode(hashlib.md5(body).digest()).decode() if body else ""
+        if self.headers.get("Content-MD5", "") != md5_str:
+            return False
+
+        expected = expectedSignature(
+            server.api_secret,
+            "POST",
+            md5_str,
+            self.headers.get("Content-Type", ""),
+            self.headers.get("Date", ""),
+            self.path
+            )
+        return hmac.compare_digest(self.headers.get("Authorization", ""), f"API {server.api_id}:{expected}")
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        if server.latency or server.latency_jitter:
+            time.sleep(max(0, server.latency + random.uniform(-server.latency_jitter, server.latency_jitter)))
+
+        if not server.throttle.allow():
+            server.inverters.count("throttled")
+            return self.sendJSON({"code" : "429", "msg" : "Too many requests"}, 429)
+
+        if not self.checkAuth(body):
+            server.inverters.count("auth_failures")
+            return self.sendJSON({"code" : "403", "msg" : "Signature verification failed"}, 403)
+
+        if server.error_rate and random.random() < server.error_rate:
+            server.inverters.count("errors")
+            # Alternate between the ways that the API might fail
+            if random.random() < 0.5:
+                return self.sendJSON({"code" : "500", "msg" : "Internal error"}, 500)
+            return self.sendJSON({"code" : "1", "msg" : "Device busy"})
+
+        try:
+            req = json.loads(body)
+        except ValueError:
+            return self.sendJSON({"code" : "1", "msg" : "invalid json"}, 400)
+
+        if self.path.startswith("/v1/api/"):
+            return self.handleV1(req)
+
+        if "inverterSn" not in req or str(req.get("cid")) != "103":
+            return self.sendJSON({"code" : "1", "msg" : "unsupported request"})
+
+        sn = req['inverterSn']
+        if self.path == "/v2/api/atRead":
+            value = self.server.inverters.read(sn)
+            return self.sendJSON({
+                "msg" : "success",
+                "code" : "0",
+                "data" : {
+                    "msg" : value,
+                    "yuanzhi" : value,
+                    "needLoop" : "false"
+                    }
+                })
+
+        if self.path == "/v2/api/control":
+            if "value" not in req or len(req['value'].split(",")) != 12:
+                return self.sendJSON({"code" : "1", "msg" : "invalid value"})
+
+            self.server.inverters.write(sn, req['value'])
+            return self.sendJSON({"msg" : "success", "code" : "0", "data" : []})
+
+        self.sendJSON({"code" : "404"}, 404)
+
+    def handleV1(self, req):
+        ''' Monitoring endpoints
+        '''
+        inverters = self.server.inverters
+
+        if self.path == "/v1/api/inverterList":
+            inverters.count("inverterList")
+            size = int(req.get("pageSize", 20))
+            current = int(req.get("pageNo", 1))
+            serials = inverters.serials
+            records = [inverters.detail(sn) for sn in serials[(current - 1) * size:current * size]]
+            return self.sendJSON({
+                "success" : True,
+                "code" : "0",
+                "msg" : "success",
+                "data" : {
+                    "inverterStatusVo" : {"all" : len(serials), "normal" : len(serials), "fault" : 0, "offline" : 0},
+                    "page" : {
+                        "records" : records,
+                        "total" : len(serials),
+                        "size" : size,
+                        "current" : current,
+                        "pages" : (len(serials) + size - 1) // size
+                        }
+                    }
+                })
+
+        if self.path == "/v1/api/inverterDetail":
+            inverters.count("inverterDetail")
+            sn = req.get("sn", False)
+            if not sn or sn not in inverters.serials:
+                return self.sendJSON({"success" : False, "code" : "1", "msg" : "inverter not found"})
+            return self.sendJSON({"success" : True, "code" : "0", "msg" : "success", "data" : inverters.detail(sn)})
+
+        if self.path in ["/v1/api/inverterMonth", "/v1/api/inverterYear"]:
+            inverters.count("inverterHistory")
+            sn = req.get("sn", False)
+            if not sn or sn not in inverters.serials:
+                return self.sendJSON({"success" : False, "code" : "1", "msg" : "inverter not found"})
+
+            if self.path == "/v1/api/inverterMonth":
+                year, month = [int(x) for x in req['month'].split("-")]
+                days = (datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.date(year, month, 1)).days
+                periods = [f"{req['month']}-{d:02d}" for d in range(1, days + 1)]
+            else:
+                periods = [f"{req['year']}-{m:02d}" for m in range(1, 13)]
+
+            return self.sendJSON({"success" : True, "code" : "0", "msg" : "success",
+                                  "data" : [inverters.history(sn, p) for p in periods]})
+
+        self.sendJSON({"code" : "404"}, 404)
+
+
+def createServer(host="127.0.0.1", port=13333, debug=False, api_id="1234", api_secret="abcde",
+                 latency=0, latency_jitter=0, error_rate=0, throttle=0, throttle_window=5, apply_delay=0,
+                 inverters=3):
+    ''' Create (but don't start) a fake API server
+    '''
+    server = ThreadingHTTPServer((host, port), FakeSolisHandler)
+    server.daemon_threads = True
+    server.inverters = FakeInverter(apply_delay, inverters)
+    server.throttle = Throttle(throttle, throttle_window)
+    server.debug = debug
+    server.api_id = str(api_id)
+    server.api_secret = api_secret
+    server.latency = latency
+    server.latency_jitter = latency_jitter
+    server.error_rate = error_rate
+    return server
+
+
+def serverFromEnv(host=None, port=None):
+    ''' Create a server configured by environment variables
+    '''
+    return createServer(
+        host or os.getenv("FAKE_HOST", "127.0.0.1"),
+        port or int(os.getenv("FAKE_PORT", 13333)),
+        os.getenv("DEBUG", "false").lower() == "true",
+        os.getenv("FAKE_API_ID", "1234"),
+        os.getenv("FAKE_API_SECRET", "abcde"),
+        float(os.getenv("FAKE_LATENCY", 0)),
+        float(os.getenv("FAKE_LATENCY_JITTER", 0)),
+        float(os.getenv("FAKE_ERROR_RATE", 0)),
+        int(os.getenv("FAKE_THROTTLE", 0)),
+        float(os.getenv("FAKE_THROTTLE_WINDOW", 5)),
+        float(os.getenv("FAKE_APPLY_DELAY", 0)),
+        int(os.getenv("FAKE_INVERTERS", 3))
+        )
+
+
+if __name__ == "__main__":
+    server = serverFromEnv()
+    print(f"Fake Soliscloud listening on http://{server.server_address[0]}:{server.server_address[1]}")
+    server.serve_forever()
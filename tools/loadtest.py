@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+#
+# Drive the control server's endpoints at fixed concurrency
+# levels and report latency percentiles and throughput
+#
+# With --spawn, a fake Soliscloud API (see fake_soliscloud.py)
+# and the control server are started locally so that results
+# don't depend on (or consume the rate limit of) the real API.
+# FAKE_* environment variables configure the fake API and
+# all other environment variables are passed to the server.
+#
+# Examples
+#
+#    loadtest.py --spawn --concurrency 1,4,16 --requests 500
+#    loadtest.py --url http://127.0.0.1:8080 --endpoint startCharge --endpoint stopCharge
+#
+# Copyright (c) 2025, B Tasker
+# Released under BSD 3-Clause License
+#
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import fake_soliscloud
+
+
+def percentile(values, pct):
+    ''' Nearest-rank percentile of a sorted list
+    '''
+    if not values:
+        return 0
+    idx = max(0, min(len(values) - 1, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[idx]
+
+
+def run(url, endpoints, concurrency, total, body=None, auth=None):
+    ''' Place total requests, concurrency at a time, cycling through
+    endpoints, and return a dict of results
+    '''
+    statuses = {}
+    latencies = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(i):
+        # Keep a connection per client thread
+        if not hasattr(local, "session"):
+            local.session = requests.session()
+
+        endpoint = endpoints[i % len(endpoints)]
+        start = time.time()
+        try:
+            status = local.session.post(f"{url}/api/v1/{endpoint}", json=body or {}, auth=auth).status_code
+        except requests.exceptions.RequestException:
+            status = "error"
+        elapsed = time.time() - start
+
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {
+        "concurrency" : concurrency,
+        "requests" : total,
+        "elapsed" : elapsed,
+        "throughput" : total / elapsed,
+        "p50" : percentile(latencies, 50),
+        "p95" : percentile(latencies, 95),
+        "p99" : percentile(latencies, 99),
+        "statuses" : statuses
+        }
+
+
+def spawn(port, api_port):
+    ''' Start a fake API (in a thread) and the control server
+    (as a subprocess) pointing at it
+    '''
+    fake = fake_soliscloud.serverFromEnv(port=api_port)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+
+    env = dict(os.environ)
+    env.setdefault("API_URL", f"http://127.0.0.1:{api_port}")
+    env.setdefault("API_ID", fake.api_id)
+    env.setdefault("API_SECRET", fake.api_secret)
+    env["LISTEN_HOST"] = "127.0.0.1"
+    env["LISTEN_PORT"] = str(port)
+
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "server.py")
+    proc = subprocess.Popen([sys.executable, server_path], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Wait for it to come up
+    for i in range(50):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            break
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+
+    return fake, proc
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Soliscloud control server")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="Control server URL")
+    parser.add_argument("--endpoint", action="append", help="Endpoint(s) to call, default stopCharge")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per concurrency level")
+    parser.add_argument("--body", default="{}", help="JSON request body")
+    parser.add_argument("--user", help="Basic auth username")
+    parser.add_argument("--password", help="Basic auth password")
+    parser.add_argument("--spawn", action="store_true", help="Start a fake API and server locally")
+    parser.add_argument("--port", type=int, default=18080, help="Port for the spawned server")
+    parser.add_argument("--api-port", type=int, default=13334, help="Port for the spawned fake API")
+    parser.add_argument("--json", action="store_true", help="Output results as JSON")
+    args = parser.parse_args()
+
+    endpoints = args.endpoint or ["stopCharge"]
+    auth = (args.user, args.password) if args.user else None
+
+    fake = proc = False
+    url = args.url
+    if args.spawn:
+        fake, proc = spawn(args.port, args.api_port)
+        url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        results = []
+        for concurrency in [int(x) for x in args.concurrency.split(",")]:
+            before = dict(fake.inverters.stats) if fake else {}
+            res = run(url, endpoints, concurrency, args.requests, json.loads(args.body), auth)
+            if fake:
+                res['upstream'] = {k : v - before[k] for k, v in fake.inverters.stats.items()}
+            results.append(res)
+
+            if not args.json:
+                print(f"concurrency {concurrency:>4}: {res['throughput']:8.1f} req/s  "
+                      f"p50 {res['p50'] * 1000:8.1f}ms  p95 {res['p95'] * 1000:8.1f}ms  "
+                      f"p99 {res['p99'] * 1000:8.1f}ms  statuses {res['statuses']}"
+                      + (f"  upstream {res['upstream']}" if fake else ""))
+
+        if args.json:
+            print(json.dumps(results, indent=2))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()